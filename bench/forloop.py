@@ -0,0 +1,41 @@
+"""Iterating a `for` loop over 1M items, from command output and from a
+literal word list, with an empty body:
+
+    python -m bench.forloop [ITEMS]
+
+Prints items/s, how long the body waited for its first item and the peak
+RSS so far. Command output is streamed, so the first run stays flat; the
+word list has to be parsed whole first.
+"""
+import sys, time, resource
+from core.executor import Executor
+from core.lexer import Lexer
+from core.parser import Parser
+
+def build(src):
+    return Parser(Lexer(line=src).nextToken()).parse()
+
+def measure(ex, name, node, items):
+    start = time.perf_counter()
+    words = ex.expander.iterWords(node.items)
+    try:
+        next(words)
+    finally:
+        # stop the producer now rather than whenever the generator is collected
+        words.close()
+    firstItem = time.perf_counter() - start
+    start = time.perf_counter()
+    ex.run(node)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:8} {items / elapsed:12,.0f} items/s   first item {firstItem * 1000:6.1f} ms   peak RSS {rss:6.1f} MB")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    ex = Executor()
+    measure(ex, "command", build(f"for i in @(seq 1 {n}) -> {{ }}"), n)
+    words = " ".join(str(i) for i in range(1, n + 1))
+    measure(ex, "words", build(f"for i in {words} -> {{ }}"), n)
+
+if __name__ == "__main__":
+    main()
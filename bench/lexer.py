@@ -0,0 +1,32 @@
+"""Lexer throughput on a large generated script.
+
+    python -m bench.lexer [LINES]
+"""
+import sys, time
+from core.lexer import Lexer
+
+LINES = (
+    'echo "building @target in ${dir}" >> build.log',
+    "x=value_@i",
+    "if (test -f /etc/passwd) -> { cat /etc/passwd | grep root | wc -l }",
+    "while (@running == 1) -> { sleep 1 && check_status 2> err.log || break }",
+    "# a comment that the lexer has to skip over",
+    "ls -la /usr/lib/*.so 'quoted arg' <<< here",
+)
+
+def script(lines):
+    return "\n".join(LINES[i % len(LINES)] for i in range(lines)) + "\n"
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    src = script(lines)
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        tokens = Lexer(line=src).nextToken()
+        best = min(best, time.perf_counter() - start)
+    print(f"{lines} lines, {len(src) / 1e6:.2f} MB, {len(tokens)} tokens")
+    print(f"best of 5: {best * 1000:.1f} ms, {lines / best:,.0f} lines/s, {len(src) / best / 1e6:.2f} MB/s")
+
+if __name__ == "__main__":
+    main()
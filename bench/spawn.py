@@ -0,0 +1,41 @@
+"""Spawn rate of external commands, fork fallback versus posix_spawn.
+
+Runs a tight `while (@i < N) -> { true; i += 1 }` loop through the executor
+once per engine:
+
+    python -m bench.spawn [N]
+
+The rate includes the loop's own comparison and increment, which cost the
+same under both engines.
+"""
+import sys, time
+from core.executor import Executor
+from core.lexer import Lexer
+from core.parser import Parser
+
+def build(src):
+    return Parser(Lexer(line=src).nextToken()).parse()
+
+def rate(ex, loop, n):
+    ex.vars.set("i", "0")
+    start = time.perf_counter()
+    ex.run(loop)
+    elapsed = time.perf_counter() - start
+    assert ex.vars.get("i") == str(n), ex.vars.get("i")
+    return n / elapsed
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    ex = Executor()
+    loop = build(f"while (@i < {n}) -> {{ true; i += 1 }}")
+    warmup = build("while (@i < 10) -> { true; i += 1 }")
+    results = {}
+    for name, useSpawn in (("fork", False), ("posix_spawn", True)):
+        ex.useSpawn = useSpawn
+        rate(ex, warmup, 10)
+        results[name] = rate(ex, loop, n)
+        print(f"{name:12} {results[name]:10.1f} spawns/s")
+    print(f"{'speedup':12} {results['posix_spawn'] / results['fork']:10.2f}x")
+
+if __name__ == "__main__":
+    main()
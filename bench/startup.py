@@ -0,0 +1,54 @@
+"""Startup cost of `rayshell -c`, the way orchestration invokes it:
+
+    python -m bench.startup [RUNS]
+
+Times RUNS launches of `python -m core -c true` against a bare `python -c
+pass`, then lists the slowest imports of core.repl as `-X importtime`
+reports them (self time, in us). Runs with stdin on /dev/null and no
+controlling terminal, so it measures the non-interactive path only.
+"""
+import os, sys, time, subprocess
+
+TOP = 12
+
+def launch(argv, runs):
+    best = float("inf")
+    total = 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       start_new_session=True, check=True)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+    return best, total / runs
+
+def importTimes():
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import core.repl"],
+                         stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(own), int(cumulative), name.strip()))
+    return rows
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(root)
+    bare = launch([sys.executable, "-c", "pass"], runs)
+    shell = launch([sys.executable, "-m", "core", "-c", "true"], runs)
+    for name, (best, mean) in (("python", bare), ("rayshell -c", shell)):
+        print(f"{name:12} best {best * 1000:7.1f} ms   mean {mean * 1000:7.1f} ms")
+    print(f"{'overhead':12} best {(shell[0] - bare[0]) * 1000:7.1f} ms")
+
+    rows = importTimes()
+    repl = next(c for _, c, name in rows if name == "core.repl")
+    print(f"\nimport core.repl {repl / 1000:.1f} ms, slowest imports:")
+    for own, cumulative, name in sorted(rows, reverse=True)[:TOP]:
+        print(f"  {own:7} {cumulative:8}  {name}")
+
+if __name__ == "__main__":
+    main()
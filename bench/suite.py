@@ -0,0 +1,190 @@
+"""The whole front end and executor, one stage at a time, against a stored
+baseline:
+
+    python -m bench.suite [--quick] [--only PREFIX] [--save] [--baseline PATH]
+                          [--threshold FRACTION]
+
+Each case reports the best rate out of a few rounds. --save records this run
+as the baseline (bench/baseline.json by default, not checked in: rates only
+mean something on comparable hardware). Later runs show every case next to
+its stored rate and exit 1 if any got slower by more than the threshold
+(0.25 by default). A baseline from another Python, machine type or mode
+(--quick or not) is not compared against: with the default path that is a
+warning, but a --baseline given explicitly, say one file per CI runner, must
+exist and match or the run exits 2.
+
+Needs no terminal: external commands are stand-ins like `true` and `cat`.
+"""
+import os, sys, json, time, shutil, tempfile, platform, argparse
+from core.executor import Executor
+from core.lexer import Lexer
+from core.parser import Parser
+from bench.lexer import script
+
+# what a baseline must have been recorded with to be compared against; the
+# host is stored too but not matched, since CI hosts get fresh names per run
+MATCH = ("python", "machine", "quick")
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+ROUNDS = 5
+
+def best(fn, rounds=ROUNDS):
+    # fn() does one round of work; returns the fastest round in seconds.
+    fastest = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+
+def tokens(src):
+    return Lexer(line=src).nextToken()
+
+def parse(src):
+    return Parser(tokens(src)).parse()
+
+def nested(keyword, header, depth):
+    return f"{keyword} {header} -> {{ " * depth + "echo x" + " }" * depth
+
+# Cases yield (name, units of work per round, unit, fn).
+
+def lexerCases(scale):
+    for lines in (1000, 10000, 100000):
+        lines = max(lines // scale, 10)
+        src = script(lines)
+        yield f"lex.script.{lines}", lines, "lines/s", lambda src=src: tokens(src)
+
+def parserCases(scale):
+    depth = 100
+    for name, src in (("if", nested("if", "(true)", depth)),
+                      ("while", nested("while", "(@i < 3)", depth))):
+        toks = tokens(src)
+        n = max(200 // scale, 5)
+        yield f"parse.nested.{name}.{depth}", n, "parses/s", lambda toks=toks, n=n: [Parser(toks).parse() for _ in range(n)]
+    terms = 5000
+    toks = tokens(" && ".join(["true"] * terms))
+    yield f"parse.andchain.{terms}", terms, "terms/s", lambda: Parser(toks).parse()
+
+def expanderCases(scale, ex, scratch):
+    for i in range(200):
+        open(os.path.join(scratch, f"file{i}.txt"), "w").close()
+    ex.vars.set("name", "world")
+    ex.vars.set("dir", scratch)
+    width = 1000
+    rounds = max(100 // scale, 2)
+    words = {
+        # one variable keeps the command from being marked static
+        "plain": ["word"] * (width - 1) + ["@name"],
+        "vars": ["@name"] * width,
+        "dstring": ['"hello @name in @dir"'] * width,
+        "glob": [f"{scratch}/file1*.txt"] * (width // 10),
+    }
+    for name, args in words.items():
+        node = parse("echo " + " ".join(args))
+        yield f"expand.{name}.{len(args)}", rounds * len(args), "words/s", \
+            lambda node=node: [ex.expander.expand(node) for _ in range(rounds)]
+
+def executorCases(scale, ex):
+    n = max(2000 // scale, 20)
+    m = max(200 // scale, 5)
+    cases = [("exec.builtin", "echo x > /dev/null", n),
+             ("exec.function", "nop", n),
+             ("exec.external", "true", m)]
+    cases += [(f"exec.pipeline.{k}", " | ".join(["true"] + ["cat"] * (k - 1)), m) for k in (2, 4, 8)]
+    ex.run(parse("fn nop() -> { }"))
+    for name, src, count in cases:
+        node = parse(src)
+        yield name, count, "runs/s", lambda node=node, count=count: [ex.run(node) for _ in range(count)]
+    items = max(100000 // scale, 100)
+    loop = parse(f"for i in @(seq 1 {items}) -> {{ }}")
+    yield f"exec.for.{items}", items, "items/s", lambda: ex.run(loop)
+
+def run(args):
+    scale = 10 if args.quick else 1
+    ex = Executor()
+    scratch = tempfile.mkdtemp(prefix="rayshell-bench-")
+    results = {}
+    try:
+        stages = [lexerCases(scale), parserCases(scale),
+                  expanderCases(scale, ex, scratch), executorCases(scale, ex)]
+        for stage in stages:
+            for name, units, unit, fn in stage:
+                if args.only and not name.startswith(args.only):
+                    continue
+                fn()
+                results[name] = (units / best(fn), unit)
+                yield name, results[name]
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    args.results = results
+
+def environment(quick):
+    return {"host": platform.node(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "quick": quick}
+
+def loadBaseline(path, quick, required):
+    # With required, a baseline that can't be compared against is an error.
+    def skip(reason):
+        if required:
+            print(f"error: {reason}", file=sys.stderr)
+            sys.exit(2)
+        print(f"warning: {reason}; --save records one for this run", file=sys.stderr)
+        return {}
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        results = data["results"]
+    except FileNotFoundError:
+        return skip(f"no baseline at {path}")
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return skip(f"unreadable baseline {path}: {e}")
+    here = environment(quick)
+    differ = [f"{k} {data.get(k)!r} != {here[k]!r}" for k in MATCH if data.get(k) != here[k]]
+    if differ:
+        return skip(f"not comparing with baseline {path}, it was recorded with " + ", ".join(differ))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.suite")
+    parser.add_argument("--quick", action="store_true", help="a tenth of the work, for a smoke test")
+    parser.add_argument("--only", help="only cases whose name starts with this")
+    parser.add_argument("--save", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--baseline", help=f"compare against this file, which must match (default {BASELINE})")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    args = parser.parse_args()
+
+    required = args.baseline is not None and not args.save
+    args.baseline = args.baseline or BASELINE
+    baseline = {}
+    if not (args.save and not os.path.exists(args.baseline)):
+        baseline = loadBaseline(args.baseline, args.quick, required)
+    slower = []
+    print(f"{'case':28} {'rate':>14} {'unit':10} {'baseline':>14} {'change':>8}")
+    for name, (rate, unit) in run(args):
+        line = f"{name:28} {rate:14,.0f} {unit:10}"
+        if name in baseline:
+            base = baseline[name]["rate"]
+            change = rate / base - 1
+            line += f" {base:14,.0f} {change:+8.1%}"
+            if change < -args.threshold:
+                line += "  SLOWER"
+                slower.append(name)
+        print(line, flush=True)
+
+    if args.save:
+        data = environment(args.quick)
+        data["results"] = {name: {"rate": round(rate, 1), "unit": unit}
+                           for name, (rate, unit) in args.results.items()}
+        with open(args.baseline, "w") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+        print(f"saved {args.baseline}")
+    if slower:
+        print(f"{len(slower)} case(s) slower than the baseline by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import re
+
+# Integer arithmetic for @(( ... )) and name+=value: C operators and
+# precedence, integers only, division truncating toward zero. An expression
+# is compiled once into nested closures; evaluating it takes a lookup
+# function that returns a variable's raw value (an int, a string or None).
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<num>0[xX][0-9a-fA-F]+|\d+)
+  | (?P<name>[@$]\{\w+\}|[@$]?[A-Za-z_]\w*)
+  | (?P<op>\*\*|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%<>&^|!~()?:])
+)""", re.VERBOSE)
+
+# binding power of each binary operator; ** is the only right-associative one
+BINARY = {
+    "||": 2, "&&": 3, "|": 4, "^": 5, "&": 6,
+    "==": 7, "!=": 7,
+    "<": 8, "<=": 8, ">": 8, ">=": 8,
+    "<<": 9, ">>": 9,
+    "+": 10, "-": 10,
+    "*": 11, "/": 11, "%": 11,
+    "**": 12,
+}
+UNARY = 13
+
+class ArithError(Exception):
+    # A bad expression or a bad value; Expander.arithmetic names the
+    # expression and Executor.run reports it as a failed command.
+    pass
+
+def div(a, b):
+    if b == 0:
+        raise ArithError("division by 0")
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+def mod(a, b):
+    return a - b * div(a, b)
+
+def shift(a, b, left):
+    if b < 0:
+        raise ArithError("negative shift count")
+    return a << b if left else a >> b
+
+def power(a, b):
+    if b < 0:
+        raise ArithError("exponent less than 0")
+    return a ** b
+
+OPS = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": div,
+    "%": mod,
+    "**": power,
+    "<<": lambda a, b: shift(a, b, True),
+    ">>": lambda a, b: shift(a, b, False),
+    "&": lambda a, b: a & b,
+    "^": lambda a, b: a ^ b,
+    "|": lambda a, b: a | b,
+    "==": lambda a, b: int(a == b),
+    "!=": lambda a, b: int(a != b),
+    "<": lambda a, b: int(a < b),
+    "<=": lambda a, b: int(a <= b),
+    ">": lambda a, b: int(a > b),
+    ">=": lambda a, b: int(a >= b),
+}
+
+def tokenize(expr):
+    tokens = []
+    pos = 0
+    end = len(expr.rstrip())
+    while pos < end:
+        m = TOKEN_RE.match(expr, pos)
+        if m is None or m.end() == pos:
+            raise ArithError(f"syntax error near '{expr[pos:].strip()}'")
+        pos = m.end()
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+    return tokens
+
+def variable(name):
+    if name[0] in "@$":
+        name = name[2:-1] if name[1] == "{" else name[1:]
+
+    def get(lookup):
+        value = lookup(name)
+        if type(value) is int:
+            return value
+        if value is None or not value.strip():
+            return 0
+        try:
+            return int(value, 0) if value.strip()[:2].lower() == "0x" else int(value)
+        except ValueError:
+            raise ArithError(f"{name}: {value!r} is not a number") from None
+    return get
+
+class Compiler:
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def expect(self, value):
+        if self.peek()[1] != value:
+            raise ArithError(f"'{value}' expected")
+        self.pos += 1
+
+    def compile(self):
+        if not self.tokens:
+            return lambda lookup: 0
+        fn = self.ternary()
+        if self.pos != len(self.tokens):
+            raise ArithError(f"syntax error near '{self.peek()[1]}'")
+        return fn
+
+    def ternary(self):
+        cond = self.binary(1)
+        if self.peek()[1] != "?":
+            return cond
+        self.pos += 1
+        a = self.ternary()
+        self.expect(":")
+        b = self.ternary()
+        return lambda lookup: a(lookup) if cond(lookup) else b(lookup)
+
+    def binary(self, minPower):
+        left = self.unary()
+        while True:
+            kind, op = self.peek()
+            bp = BINARY.get(op) if kind == "op" else None
+            if bp is None or bp < minPower:
+                return left
+            self.pos += 1
+            right = self.binary(bp if op == "**" else bp + 1)
+            left = self.combine(op, left, right)
+
+    def combine(self, op, a, b):
+        if op == "&&":
+            return lambda lookup: int(bool(a(lookup)) and bool(b(lookup)))
+        if op == "||":
+            return lambda lookup: int(bool(a(lookup)) or bool(b(lookup)))
+        f = OPS[op]
+        return lambda lookup: f(a(lookup), b(lookup))
+
+    def unary(self):
+        kind, value = self.peek()
+        if kind is None:
+            raise ArithError("operand expected")
+        self.pos += 1
+        if kind == "num":
+            n = int(value, 0) if value[:2].lower() == "0x" else int(value)
+            return lambda lookup: n
+        if kind == "name":
+            return variable(value)
+        if value == "(":
+            fn = self.ternary()
+            self.expect(")")
+            return fn
+        if value in ("-", "+", "!", "~"):
+            a = self.binary(UNARY)
+            if value == "-":
+                return lambda lookup: -a(lookup)
+            if value == "+":
+                return a
+            if value == "!":
+                return lambda lookup: int(not a(lookup))
+            return lambda lookup: ~a(lookup)
+        raise ArithError(f"syntax error near '{value}'")
+
+def compile(expr):
+    return Compiler(expr).compile()
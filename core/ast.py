@@ -1,5 +1,4 @@
 from enum import Enum
-import json
 
 class ASTNodeType(Enum):
     BLOCK = "BLOCK"
@@ -14,6 +13,9 @@ class ASTNodeType(Enum):
     WHILE = "WHILE"
     FOR = "FOR"
     CASE = "CASE"
+    SUBSTITUTION = "SUBSTITUTION"
+    ARITHMETIC = "ARITHMETIC"
+    FUNCTION = "FUNCTION"
 
 class ASTNode:
     def __init__(self, type_, **kwargs):
@@ -46,7 +48,7 @@ class BlockNode(ASTNode):
         return f"BlockNode(statements={self.statements})"
 
 class CommandNode(ASTNode):
-    def __init__(self, name, args, stdin=None, stdout=None, stdoutAppend=False, stderr=None, stderrAppend=False, assignments=None, background=False):
+    def __init__(self, name, args, stdin=None, stdout=None, stdoutAppend=False, stderr=None, stderrAppend=False, assignments=None, background=False, static=False):
         super().__init__(ASTNodeType.COMMAND, name=name, args=args)
         self.stdin = stdin
         self.stdout = stdout
@@ -55,6 +57,9 @@ class CommandNode(ASTNode):
         self.stderrAppend = stderrAppend
         self.assignments = assignments
         self.background = background
+        # True when every word is a literal: the executor runs the node as
+        # parsed and never hands it to the Expander.
+        self.static = static
 
 class BinaryOpNode(ASTNode):
     def __init__(self, op, left, right):
@@ -71,8 +76,8 @@ class PipeLineNode(ASTNode):
         return f"PipeLineNode(cmds = {self.cmds})"
     
 class AssignmentNode(ASTNode):
-    def __init__(self, name, value, export=False):
-        super().__init__(ASTNodeType.ASSIGNMENT, name=name, value=value, export=export)
+    def __init__(self, name, value, export=False, local=False):
+        super().__init__(ASTNodeType.ASSIGNMENT, name=name, value=value, export=export, local=local)
     def __repr__(self):
         return f"AssignmentNode({self.name} = {self.value})"
 
@@ -108,6 +113,90 @@ class WhileNode(ASTNode):
     def __repr__(self):
         return f"WhileNode(condition={self.condition}, body={self.body})"
 
+class ForNode(ASTNode):
+    def __init__(self, var, items, body):
+        super().__init__(ASTNodeType.FOR, var=var, items=items, body=body)
+        self.var = var
+        self.items = items
+        self.body = body
+    def __repr__(self):
+        return f"ForNode(var={self.var}, items={self.items}, body={self.body})"
+
+class CaseNode(ASTNode):
+    # patterns[i] lists the patterns of arm i, bodies[i] is its block. static
+    # is True when no pattern needs expanding, so the compiled matcher can be
+    # kept on the node for good.
+    def __init__(self, word, patterns, bodies, static=False):
+        super().__init__(ASTNodeType.CASE, word=word, patterns=patterns, bodies=bodies, static=static)
+        self.word = word
+        self.patterns = patterns
+        self.bodies = bodies
+        self.static = static
+    def __repr__(self):
+        return f"CaseNode(word={self.word}, patterns={self.patterns}, bodies={self.bodies})"
+
+class SubstitutionNode(ASTNode):
+    # @( ... ): source is the text between the parens, body its parse.
+    def __init__(self, source, body):
+        super().__init__(ASTNodeType.SUBSTITUTION, source=source, body=body)
+        self.source = source
+        self.body = body
+    def __repr__(self):
+        return f"SubstitutionNode({self.source!r})"
+
+class FunctionNode(ASTNode):
+    # fn name(params) -> { body }; params name the positional arguments.
+    def __init__(self, name, params, body):
+        super().__init__(ASTNodeType.FUNCTION, name=name, params=params, body=body)
+        self.name = name
+        self.params = params
+        self.body = body
+    def __repr__(self):
+        return f"FunctionNode(name={self.name}, params={self.params}, body={self.body})"
+
+class ArithmeticNode(ASTNode):
+    # @(( ... )); expr is the source text, compiled on first use.
+    def __init__(self, expr):
+        super().__init__(ASTNodeType.ARITHMETIC, expr=expr)
+        self.expr = expr
+    def __repr__(self):
+        return f"ArithmeticNode({self.expr!r})"
+
+NODECLASSES = {
+    ASTNodeType.BLOCK: BlockNode,
+    ASTNodeType.COMMAND: CommandNode,
+    ASTNodeType.PIPELINE: PipeLineNode,
+    ASTNodeType.BINARYOP: BinaryOpNode,
+    ASTNodeType.ASSIGNMENT: AssignmentNode,
+    ASTNodeType.ASSIGNMENTLIST: AssignmentListNode,
+    ASTNodeType.VARREF: VarRefNode,
+    ASTNodeType.IF: IfNode,
+    ASTNodeType.WHILE: WhileNode,
+    ASTNodeType.FOR: ForNode,
+    ASTNodeType.CASE: CaseNode,
+    ASTNodeType.SUBSTITUTION: SubstitutionNode,
+    ASTNodeType.ARITHMETIC: ArithmeticNode,
+    ASTNodeType.FUNCTION: FunctionNode,
+}
+NODETYPES = {t.value: t for t in NODECLASSES}
+
+def fromDict(data):
+    # Inverse of ASTNode.toDict: any dict whose "type" names a node type is
+    # rebuilt as that node, everything else is returned as is.
+    if isinstance(data, dict):
+        nodeType = NODETYPES.get(data.get("type"))
+        if nodeType is None:
+            return {k: fromDict(v) for k, v in data.items()}
+        node = NODECLASSES[nodeType].__new__(NODECLASSES[nodeType])
+        for k, v in data.items():
+            node.__dict__[k] = fromDict(v)
+        node.type = nodeType
+        return node
+    if isinstance(data, list):
+        return [fromDict(item) for item in data]
+    return data
+
 def saveASTtoJson(node, filename = "ast.json"):
+    import json
     with open (filename, "w") as f:
         json.dump(node.toDict(), f, indent=4)
\ No newline at end of file
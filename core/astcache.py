@@ -0,0 +1,94 @@
+import os, marshal
+from core.ast import fromDict
+from core.parser import GRAMMAR_VERSION
+
+# Parsed scripts are cached next to the script, the way CPython keeps
+# __pycache__: <dir>/__rshcache__/<name>.v<grammar>.rshc holds a key record,
+# one marshalled toDict() record per top-level statement and an end record
+# with the statement count. A cache file is read and checked in full before
+# any of it runs; one that is damaged or cut short is deleted and the script
+# parsed again. Set RAYSHELL_NO_CACHE to neither read nor write the cache.
+
+CACHEDIR = "__rshcache__"
+END = "end"
+
+def cachePath(path):
+    d, name = os.path.split(os.path.abspath(path))
+    return os.path.join(d, CACHEDIR, f"{name}.v{GRAMMAR_VERSION}.rshc")
+
+def cacheKey(path, st):
+    return (GRAMMAR_VERSION, os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+def enabled():
+    return not os.environ.get("RAYSHELL_NO_CACHE")
+
+def load(path, f):
+    if not enabled():
+        return None
+    target = cachePath(path)
+    try:
+        cache = open(target, "rb")
+    except OSError:
+        return None
+    with cache:
+        try:
+            key = marshal.load(cache)
+        except (EOFError, ValueError, TypeError):
+            key = None
+        if key != cacheKey(path, os.fstat(f.fileno())):
+            return None
+        statements = readStatements(cache)
+    if statements is None:
+        try:
+            os.unlink(target)
+        except OSError:
+            pass
+    return statements
+
+def readStatements(cache):
+    # The statements of a complete, undamaged cache file, else None.
+    statements = []
+    try:
+        while True:
+            data = marshal.load(cache)
+            if isinstance(data, tuple):
+                break
+            statements.append(fromDict(data))
+    except (EOFError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+    if data != (END, len(statements)) or cache.read(1):
+        return None
+    return statements
+
+def record(path, f, statements):
+    # Pass statements through while writing them to a temporary cache file;
+    # it only replaces the real one once the whole script parsed cleanly.
+    if not enabled():
+        yield from statements
+        return
+    key = cacheKey(path, os.fstat(f.fileno()))
+    target = cachePath(path)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        out = open(tmp, "wb")
+    except OSError:
+        yield from statements
+        return
+
+    try:
+        with out:
+            marshal.dump(key, out)
+            count = 0
+            for node in statements:
+                marshal.dump(node.toDict(), out)
+                count += 1
+                yield node
+            marshal.dump((END, count), out)
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
@@ -1,20 +1,76 @@
-import subprocess, os, ctypes, signal
-from core.shellBuiltins import BUILTINS, BuiltinFns
+import os, sys, signal, select, threading, operator
+from core.shellBuiltins import BUILTINS, STATEFUL_BUILTINS, STDIN_BUILTINS, BuiltinFns, FunctionReturn
 from core.jobs import Job, JobTable
-
-libc = ctypes.CDLL("libc.so.6")
+from core.ast import PipeLineNode
+from core.expander import Expander
+from core.variables import VariableStore
+from core.reaper import Reaper
+from core.spawn import spawn, CHILD_SIGDEF, HAVE_SPAWN
+from core.patterns import Matcher
+from core.arith import ArithError
+
+CAPTURE_CHUNK = 1 << 16
+
+COMPARE = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+def numeric(word):
+    if type(word) is int:
+        return word
+    try:
+        return int(word)
+    except ValueError:
+        pass
+    try:
+        return float(word)
+    except ValueError:
+        return None
 
 class Executor:
+    useSpawn = HAVE_SPAWN
+
     def __init__(self):
         self.cwd = os.getcwd()
         self.fg_pgid = 0
+        # off in a forked capture: its commands stay in the shell's process
+        # group and never take the terminal
+        self.jobControl = True
+        # captures being read; ^C and ^Z reach them without the shell's help
+        self.captures = 0
         self.lastStatus = 0
         self.jobTable = JobTable()
-        self.tty_fd = os.open("/dev/tty", os.O_RDWR)
+        self._tty = None
+        self.reaper = Reaper(self.jobTable)
+        self.narrativeEngine = None
+        self.vars = VariableStore()
+        self.expander = Expander(self)
+        self.options = {"lastpipe": False}
+        self.cmdHash = {}
+        self.hashPath = self.vars.get("PATH", os.defpath)
+        self.functions = {}
+        self.callDepth = 0
+        self.history = None
+
+    @property
+    def tty_fd(self):
+        # Opened on first use, since -c and script runs may never need it and
+        # may not have a controlling terminal at all; -1 then.
+        if self._tty is None:
+            try:
+                self._tty = os.open("/dev/tty", os.O_RDWR | os.O_CLOEXEC)
+            except OSError:
+                self._tty = -1
+        return self._tty
+
+    def setupInteractive(self):
         signal.signal(signal.SIGINT, self.sigintHandler)
         signal.signal(signal.SIGTSTP, self.sigstopHandler)
-        signal.signal(signal.SIGCHLD, self.sigchldHandler)
-        self.narrativeEngine = None
 
     def sigintHandler(self, signum, frame):
         if self.fg_pgid != 0:
@@ -23,7 +79,7 @@ class Executor:
             except ProcessLookupError:
                 pass
 
-        else:
+        elif not self.captures:
             print("\nrayshell> ", end="", flush=True)
 
     def sigstopHandler(self, signum, frame):
@@ -32,46 +88,71 @@ class Executor:
                 os.killpg(self.fg_pgid, signal.SIGTSTP)
             except ProcessLookupError:
                 pass  
-        else:
+        elif not self.captures:
             print("\nrayshell> ", end="", flush=True)
 
-    def sigchldHandler(self, signum, frame):
-        try:
-            while True:
-                pid, status = os.waitpid(-1, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
-                if pid == 0:
-                    break
-                # jobs = self.jobTable.list()
-
-                job = None
-                for j in self.jobTable.list():
-                    if pid in j.pids:
-                        job = j
-                        break
-
-                if not job:
-                    continue 
-
-                if os.WIFSTOPPED(status):
-                    job.status = 'stopped'
-                elif os.WIFEXITED(status) or os.WIFSIGNALED(status):
-                    self.jobTable.remove(job.pgid)
-        except ChildProcessError:
-            pass            
+    def resolveCommand(self, cmd, path=None):
+        if "/" in cmd:
+            return cmd if os.access(cmd, os.X_OK) else None
+
+        if path is None:
+            path = self.vars.get("PATH", os.defpath)
+        if path != self.hashPath:
+            # PATH changed since the table was filled; every entry is stale.
+            self.cmdHash.clear()
+            self.hashPath = path
+
+        entry = self.cmdHash.get(cmd)
+        if entry:
+            if os.access(entry[0], os.X_OK):
+                entry[1] += 1
+                return entry[0]
+            del self.cmdHash[cmd]
+
+        full = self.searchPath(cmd, path)
+        if full:
+            self.cmdHash[cmd] = [full, 1]
+        return full
+
+    def searchPath(self, cmd, path):
+        for d in path.split(os.pathsep):
+            full = os.path.join(d or ".", cmd)
+            if os.path.isfile(full) and os.access(full, os.X_OK):
+                return full
+        return None
 
     def run(self, node):
+        # A bad arithmetic expression fails the command it is in, like any
+        # other failed command, rather than the whole shell.
+        try:
+            return self.runNode(node)
+        except ArithError as e:
+            print(e)
+            self.lastStatus = 1
+            return 1
+
+    def runNode(self, node):
+        # Words are expanded here, right before the node runs, so loop bodies
+        # see the variables as they are on each pass.
         if node.type.name == "ASSIGNMENT":
-            os.environ[node.name] = node.value or ""
-            return 0
+            return self.assign(self.expander.expand(node))
         elif node.type.name == "ASSIGNMENTLIST":
-            for a in node.assignments:
-                os.environ[a.name] = a.value or ""
+            status = 0
+            for a in self.expander.expand(node).assignments:
+                status = self.assign(a) or status
+            return status
+        elif node.type.name == "FUNCTION":
+            self.functions[node.name] = node
             return 0
 
         if node.type.name == "COMMAND":
+            if not node.static:
+                node = self.expander.expand(node)
             return self.runCommand(node)
+        elif node.type.name == "VARREF":
+            return self.runCommand(self.expander.expand(node))
         elif node.type.name == "BLOCK":
-            self.runBlock(node)
+            return self.runBlock(node)
         elif node.type.name == "BINARYOP":
             return self.runBinary(node)
         elif node.type.name == "PIPELINE":
@@ -87,16 +168,21 @@ class Executor:
         else:
             raise NotImplementedError(f"Node type {node.type} not yet supported")
         
-    def updateEnv(self, env):
-        os.environ.clear()
-        os.environ.update(env)
-        return env
-    
+    def assign(self, a):
+        if a.local:
+            if not self.callDepth:
+                print("local: can only be used in a function")
+                return 1
+            self.vars.declare(a.name, a.value)
+        else:
+            self.vars.set(a.name, a.value)
+        return 0
+
     def handleAssignments(self, node):
-        env = os.environ.copy()
-        for assignment in getattr(node, "assignments", []):
-            env [assignment.name] = assignment.value or ""
-        return env
+        assignments = getattr(node, "assignments", None)
+        if not assignments:
+            return self.vars.environ()
+        return self.vars.environ({a.name: a.value for a in assignments})
     
     def applyRedirections(self, node):
         if node.stdin:
@@ -122,33 +208,67 @@ class Executor:
         else:
             cmd = node.name
         args = node.args if node.args else []
-        
-        env = self.handleAssignments(node)
-        if cmd in BUILTINS:
-            return self.runBuiltin(node, env, cmd)
+        if not cmd:
+            # the name was a substitution that came out empty
+            return self.lastStatus
+
+        if cmd in BUILTINS or cmd in self.functions:
+            self.lastStatus = self.runBuiltin(node, cmd)
+            return self.lastStatus
         else:
-            return self.runExternal(node, cmd, args, env)
+            return self.runExternal(node, cmd, args, self.handleAssignments(node))
     
-    def runBuiltin(self, node, env, cmd):
-        origStdout = os.dup(1)
-        origStderr = os.dup(2)
-        origEnv = os.environ.copy()
+    def runBuiltin(self, node, cmd):
+        # Only touch the fds the node actually redirects, and only shadow the
+        # variables it assigns for the duration of the call.
+        saved = []
+        if node.stdin or node.stdout or node.stderr:
+            sys.stdout.flush()
+            saved = [(fd, os.dup(fd)) for fd, target in ((0, node.stdin), (1, node.stdout), (2, node.stderr)) if target]
+        if node.assignments:
+            # exported, so commands run by a function body see them too
+            self.vars.push({a.name: a.value for a in node.assignments}, export=True)
         try:
-            if node.stdin or node.stdout or node.stderr:
+            if saved:
                 self.applyRedirections(node)
-            self.updateEnv(env)
+            if cmd in self.functions:
+                return self.callFunction(self.functions[cmd], node.args or [])
             builtin_instance = BuiltinFns(cmd, node.args, self)
             builtin_instance.narrativeEngine = self.narrativeEngine
             return builtin_instance.main() or 0
             # return BuiltinFns(cmd, node.args, self).main() or 0
         finally:
-            self.updateEnv(origEnv)
-            os.dup2(origStdout, 1)
-            os.dup2(origStderr, 2)
-            os.close(origStdout)
-            os.close(origStderr)
+            if node.assignments:
+                self.vars.pop()
+            if saved:
+                sys.stdout.flush()
+                for fd, orig in saved:
+                    os.dup2(orig, fd)
+                    os.close(orig)
         
+    def callFunction(self, fn, args):
+        # The parsed body runs in the shell itself. Positional parameters
+        # (@1 ..., @args, and the declared names) and `local` variables live
+        # in a scope that is dropped on return.
+        scope = {"0": fn.name, "args": " ".join(args)}
+        for i, arg in enumerate(args, 1):
+            scope[str(i)] = arg
+        for i, name in enumerate(fn.params):
+            scope[name] = args[i] if i < len(args) else ""
+        self.vars.push(scope)
+        self.callDepth += 1
+        try:
+            status = self.run(fn.body)
+        except FunctionReturn as r:
+            status = r.status
+        finally:
+            self.callDepth -= 1
+            self.vars.pop()
+        return status
+
     def runBinary(self, node):
+        if node.op in COMPARE:
+            return self.runCompare(node)
         leftStatus = self.run(node.left)
         if node.op == "&&":
             if leftStatus == 0:
@@ -162,64 +282,157 @@ class Executor:
             return self.run(node.right)
         else:
             raise ValueError("Expecting a binary operator")
+
+    def runCompare(self, node):
+        # Both sides are words: compared as numbers when both are numeric,
+        # as strings otherwise. Nothing is run, the result is just a status.
+        left = self.expander.expandOperand(node.left)
+        right = self.expander.expandOperand(node.right)
+        a, b = numeric(left), numeric(right)
+        if a is None or b is None:
+            a, b = str(left), str(right)
+        self.lastStatus = 0 if COMPARE[node.op](a, b) else 1
+        return self.lastStatus
     
     signal.signal(signal.SIGTTOU, signal.SIG_IGN)
     signal.signal(signal.SIGTTIN, signal.SIG_IGN)
         
     def runExternal(self, node, cmd, args, env):
         background = node.background
-        pid = os.fork()
-        if pid == 0:
-            os.setpgid(0, 0)
-            self.applyRedirections(node)
-            try:
-                os.execvpe(cmd, [cmd]+args, env)
-            except FileNotFoundError:
-                print(f"{cmd}: command not found")
-            os._exit(127)
+        path = env.get("PATH", os.defpath)
+        if path == self.vars.get("PATH", os.defpath):
+            exe = self.resolveCommand(cmd, path)
         else:
+            # a one-off PATH=... prefix must not pollute the hash table
+            exe = cmd if "/" in cmd else self.searchPath(cmd, path)
+        if exe is None:
+            print(f"{cmd}: command not found")
+            self.lastStatus = 127
+            return 127
+
+        try:
+            pid = self.launch(node, exe, [cmd]+args, env, pgid=0 if self.jobControl else None)
+        except OSError as e:
+            self.lastStatus = self.launchError(node, cmd, e)
+            return self.lastStatus
+
+        if self.jobControl:
             try:
                 os.setpgid(pid, pid)
             except OSError:
-                pass 
+                pass
 
-            job = Job(pgid=pid, pids=[pid], cmd=cmd, status='running')
-            self.jobTable.add(job)
+        job = Job(pgid=pid, pids=[pid], cmd=cmd, status='running', background=background)
+        self.jobTable.add(job)
+
+        if background:
+            print(f"[{pid}] {cmd} &")
+            return pid
+        else:
+            self.fg_pgid = pid
+            try:
+                if os.isatty(self.tty_fd):
+                    oldfg = os.tcgetpgrp(self.tty_fd)
+                    os.tcsetpgrp(self.tty_fd, pid)
+                else:
+                    oldfg = None
+
+                self.waitForeground(job)
+                if job.status == 'stopped':
+                    print(f"\n[{pid}] Stopped {cmd}")
+                else:
+                    self.lastStatus = job.codes.get(pid, 0)
+
+                return self.lastStatus
+            finally:
+                if oldfg is not None:
+                    try:
+                        os.tcsetpgrp(self.tty_fd, oldfg)
+                    except OSError:
+                        pass
+
+                self.fg_pgid = 0
+
+    def waitForeground(self, job):
+        # Without job control nothing stops for good: the shell that forked
+        # this one continues it. So only an exit ends the wait.
+        if self.jobControl:
+            return self.reaper.waitJob(job)
+        self.reaper.wait([job])
+        return job
+
+    def launch(self, node, exe, argv, env, pgid=0, stdin=None, stdout=None, stderr=None):
+        if self.useSpawn:
+            return spawn(exe, argv, env, node, pgid, stdin, stdout, stderr)
+
+        pid = os.fork()
+        if pid == 0:
+            signal.pthread_sigmask(signal.SIG_SETMASK, [])
+            if pgid is not None:
+                os.setpgid(0, pgid)
+            if stdin is not None:
+                os.dup2(stdin, 0)
+            if stdout is not None:
+                os.dup2(stdout, 1)
+            if stderr is not None:
+                os.dup2(stderr, 2)
+            for sig in CHILD_SIGDEF:
+                signal.signal(sig, signal.SIG_DFL)
+            try:
+                self.applyRedirections(node)
+            except OSError as e:
+                print(f"{e.filename}: {e.strerror}")
+                os._exit(1)
+            try:
+                os.execve(exe, argv, env)
+            except FileNotFoundError:
+                print(f"{argv[0]}: command not found")
+            except PermissionError:
+                print(f"{argv[0]}: permission denied")
+                os._exit(126)
+            os._exit(127)
+        return pid
+
+    def launchError(self, node, cmd, err):
+        # posix_spawn reports a failed redirection and a failed exec the same
+        # way, so find out which one it was.
+        if node.stdin and not os.path.exists(node.stdin):
+            print(f"{node.stdin}: No such file or directory")
+            return 1
+        for target in (node.stdout, node.stderr):
+            if target and not os.access(os.path.dirname(target) or ".", os.W_OK):
+                print(f"{target}: {err.strerror}")
+                return 1
+        if isinstance(err, PermissionError):
+            print(f"{cmd}: permission denied")
+            return 126
+        if isinstance(err, FileNotFoundError):
+            print(f"{cmd}: command not found")
+            return 127
+        print(f"{cmd}: {err.strerror}")
+        return 126
+
+    def commandName(self, node):
+        return node.name[1] if isinstance(node.name, tuple) else node.name
+
+    def pipelineExe(self, node, env):
+        if node.type.name != "COMMAND":
+            return None
+        cmd = self.commandName(node)
+        if not cmd or cmd in BUILTINS or cmd in self.functions:
+            return None
+        path = env.get("PATH", os.defpath)
+        if path != self.vars.get("PATH", os.defpath):
+            return None
+        return self.resolveCommand(cmd, path)
 
-            if background:
-                print(f"[{pid}] {cmd} &")
-                return pid
-            else:
-                self.fg_pgid = pid
-                try:
-                    if os.isatty(self.tty_fd):
-                        oldfg = os.tcgetpgrp(self.tty_fd)
-                        os.tcsetpgrp(self.tty_fd, pid)
-                    else:
-                        oldfg = None
-
-                    while True:
-                        wpid, status = os.waitpid(pid, os.WUNTRACED)
-                        if os.WIFSTOPPED(status):
-                            job.status = 'stopped'
-                            print(f"\n[{pid}] Stopped {cmd}")
-                            break
-                        elif os.WIFEXITED(status) or os.WIFSIGNALED(status):
-                            self.jobTable.remove(job.pgid)
-                            self.lastStatus = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
-                            break
-
-                    return self.lastStatus
-                finally:
-                    if oldfg is not None:
-                        try:
-                            os.tcsetpgrp(self.tty_fd, oldfg)
-                        except OSError:
-                            pass
-
-                    self.fg_pgid = 0
-    
     def runPipeline(self, node):
+        # External stages are spawned straight from the shell. Builtin stages
+        # run on threads writing to their pipe (or, with lastpipe, as the
+        # last stage in the shell itself); only builtins that change shell
+        # state, and stages of background pipelines, still fork.
+        cmds = [c if c.type.name == "COMMAND" and c.static else self.expander.expand(c) for c in node.cmds]
+        node = PipeLineNode("PIPELINE", cmds, node.background)
         n = len(node.cmds)
         fds = []
         for i in range(n - 1):
@@ -227,11 +440,54 @@ class Executor:
 
         pids = []
         pgid = None
+        stagePids = {}
+        threads = []
+        inline = None
+        keep = set()
 
         for i, cmdNode in enumerate(node.cmds):
+            stdin = fds[i - 1][0] if i > 0 else None
+            stdout = fds[i][1] if i < n - 1 else None
+            env = self.handleAssignments(cmdNode)
+            exe = self.pipelineExe(cmdNode, env)
+            if exe is not None:
+                # Plain external stage: exec it directly instead of running
+                # runCommand in a forked copy of the shell.
+                try:
+                    pid = self.launch(cmdNode, exe, [self.commandName(cmdNode)] + list(cmdNode.args or []),
+                                      env,
+                                      pgid=(pgid or 0) if self.jobControl else None,
+                                      stdin=stdin,
+                                      stdout=stdout)
+                except OSError as e:
+                    self.launchError(cmdNode, self.commandName(cmdNode), e)
+                    continue
+                if pgid is None:
+                    pgid = pid
+                if self.jobControl:
+                    try:
+                        os.setpgid(pid, pgid)
+                    except OSError:
+                        pass
+                pids.append(pid)
+                stagePids[pid] = i
+                continue
+
+            mode = self.builtinStage(cmdNode, i == n - 1, node.background)
+            if mode == "inline":
+                inline = cmdNode
+                continue
+            if mode == "thread":
+                if stdout is not None:
+                    keep.add(stdout)
+                threads.append((i, cmdNode, stdout))
+                continue
+
             pid = os.fork()
             if pid == 0:
-                os.setpgid(0, pgid if pgid is not None else 0)
+                signal.pthread_sigmask(signal.SIG_SETMASK, [])
+                if self.jobControl:
+                    os.setpgid(0, pgid if pgid is not None else 0)
                 if i > 0:
                     os.dup2(fds[i - 1][0], 0)
                 if i < n - 1:
@@ -242,23 +498,50 @@ class Executor:
                     if r != (fds[i - 1][0] if i > 0 else -1): os.close(r)
                     if w != (fds[i][1] if i < n - 1 else -1): os.close(w)
                 
-                exit_code = self.runCommand(cmdNode)
+                try:
+                    exit_code = self.runCommand(cmdNode)
+                except FunctionReturn as r:
+                    exit_code = r.status
                 os._exit(exit_code if exit_code is not None else 0)
             else:
                 # Parent process
                 if pgid is None:
                     pgid = pid
-                os.setpgid(pid, pgid)
+                if self.jobControl:
+                    os.setpgid(pid, pgid)
                 pids.append(pid)
+                stagePids[pid] = i
 
+        # Builtins never read stdin, so the shell only keeps the write ends
+        # its threads own; everything else belongs to the children now.
         for r, w in fds:
             os.close(r)
-            os.close(w)
-
-        job_cmd = " | ".join([c.name[1] if isinstance(c.name, tuple) else c.name for c in node.cmds])
-        job = Job(pgid=pgid, pids=pids, cmd=job_cmd, status='running')
-        self.jobTable.add(job)
+            if w not in keep:
+                os.close(w)
+
+        statuses = [0] * n
+        workers = []
+        for i, cmdNode, stdout in threads:
+            t = threading.Thread(target=self.runBuiltinStage, args=(cmdNode, stdout, statuses, i), daemon=True)
+            t.start()
+            workers.append(t)
+
+        if inline is not None:
+            statuses[n - 1] = self.runBuiltin(inline, self.commandName(inline))
+
+        if not pids:
+            for t in workers:
+                t.join()
+            if not threads and inline is None:
+                self.lastStatus = 127
+                return 127
+            self.lastStatus = statuses[n - 1]
+            return self.lastStatus
+
+        job_cmd = " | ".join([self.commandName(c) for c in node.cmds])
         background = node.background
+        job = Job(pgid=pgid, pids=pids, cmd=job_cmd, status='running', background=background)
+        self.jobTable.add(job)
 
         if background:
             print(f"[{pids[0]}] {job.cmd} &")
@@ -275,44 +558,16 @@ class Executor:
                 print(f"Error setting terminal foreground process group: {e}")
                 old_fg = None
 
-            last_status = 0
-            completed_pids = set()
             try:
-                while len(completed_pids) < len(pids):
-                    wpid, status = os.waitpid(-pgid, os.WUNTRACED | os.WCONTINUED)
-                    
-                    if wpid == 0: 
-                        continue
-
-                    if wpid in completed_pids: 
-                        continue
-
-                    completed_pids.add(wpid)
-                    
-                    current_job = None
-                    for j in self.jobTable.list():
-                        if wpid in j.pids:
-                            current_job = j
-                            break
-                    
-                    if not current_job: continue 
-
-                    if os.WIFSTOPPED(status):
-                        current_job.status = 'stopped'
-                        print(f"\n[{wpid}] Stopped {current_job.cmd}")
-                        break 
-                    elif os.WIFEXITED(status):
-                        last_status = os.WEXITSTATUS(status)
-                    elif os.WIFSIGNALED(status):
-                        last_status = 128 + os.WTERMSIG(status)
-                    elif os.WIFCONTINUED(status):
-                        pass
-
-                if job.status != 'stopped':
-                    self.jobTable.remove(job.pgid)
-                    self.lastStatus = last_status
+                self.waitForeground(job)
+                if job.status == 'stopped':
+                    print(f"\n[{pgid}] Stopped {job.cmd}")
                 else:
-                    pass
+                    for pid, i in stagePids.items():
+                        statuses[i] = job.codes.get(pid, 0)
+                    for t in workers:
+                        t.join()
+                    self.lastStatus = statuses[n - 1]
 
             except OSError as e:
                 print(f"Terminal control error: {e}")
@@ -324,8 +579,182 @@ class Executor:
                     except OSError:
                         pass 
                 self.fg_pgid = 0
-        return last_status
+        return statuses[n - 1]
+
+    def builtinStage(self, node, last, background):
+        if background or node.type.name != "COMMAND":
+            return None
+        cmd = self.commandName(node)
+        if cmd not in BUILTINS or cmd in self.functions:
+            return None
+        if cmd in STDIN_BUILTINS:
+            # only a forked child gets the pipe as its fd 0
+            return None
+        if last and self.options["lastpipe"]:
+            return "inline"
+        if cmd in STATEFUL_BUILTINS or node.assignments or node.stdin or node.stderr:
+            return None
+        return "thread"
+
+    def runBuiltinStage(self, node, stdout, statuses, idx):
+        out = stdout
+        try:
+            if node.stdout:
+                flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if node.stdoutAppend else os.O_TRUNC)
+                out = os.open(node.stdout, flags, 0o644)
+                if stdout is not None:
+                    os.close(stdout)
+            statuses[idx] = BuiltinFns(self.commandName(node), node.args, self,
+                                       stdout=1 if out is None else out).main() or 0
+        except BrokenPipeError:
+            statuses[idx] = 128 + signal.SIGPIPE
+        except OSError as e:
+            print(f"{self.commandName(node)}: {e.strerror}")
+            statuses[idx] = 1
+        finally:
+            if out is not None:
+                os.close(out)
     
+    def substitute(self, sub):
+        # @( ... ): the output of sub.body with trailing newlines removed, read
+        # straight off a pipe.
+        capture = self.startCapture(sub)
+        try:
+            data = self.readAll(capture[0], capture[2])
+        finally:
+            self.finishCapture(capture)
+        return data.rstrip(b"\n").decode(errors="replace")
+
+    def iterOutput(self, sub):
+        # Like substitute, but hands the output over chunk by chunk while the
+        # command is still running.
+        capture = self.startCapture(sub)
+        try:
+            while True:
+                self.awaitOutput(capture[0], capture[2])
+                chunk = os.read(capture[0], CAPTURE_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.finishCapture(capture)
+
+    def startCapture(self, sub):
+        # A lone builtin runs on a thread in the shell and a lone external
+        # command is spawned with its stdout on the pipe; only anything else
+        # costs a fork of the shell. Either way the child stays in the shell's
+        # process group, like bash's: it is not a job, and it can read the
+        # terminal without being stopped for it. Returns what finishCapture
+        # needs.
+        r, w = os.pipe()
+        statuses = [0]
+        thread = job = None
+        node = sub.body
+        if node is None:
+            os.close(w)
+            return r, thread, job, statuses
+        if node.type.name == "COMMAND" and not node.static:
+            node = self.expander.expand(node)
+        try:
+            if node.type.name == "COMMAND" and self.builtinStage(node, False, False) == "thread":
+                thread = threading.Thread(target=self.runBuiltinStage, args=(node, w, statuses, 0), daemon=True)
+                w = None
+                thread.start()
+                return r, thread, job, statuses
+
+            env = self.handleAssignments(node)
+            exe = self.pipelineExe(node, env)
+            if exe is not None:
+                try:
+                    pid = self.launch(node, exe, [self.commandName(node)] + list(node.args or []), env,
+                                      pgid=None, stdout=w)
+                except OSError as e:
+                    statuses[0] = self.launchError(node, self.commandName(node), e)
+                    return r, thread, job, statuses
+            else:
+                sys.stdout.flush()
+                pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        signal.pthread_sigmask(signal.SIG_SETMASK, [])
+                        for sig in (signal.SIGINT, signal.SIGTSTP):
+                            signal.signal(sig, signal.SIG_DFL)
+                        self.jobControl = False
+                        self._tty = -1
+                        os.close(r)
+                        os.dup2(w, 1)
+                        os.close(w)
+                        status = self.runCommand(node) if node.type.name == "COMMAND" else self.run(node)
+                        sys.stdout.flush()
+                    finally:
+                        os._exit(status or 0)
+            # keyed by its pid; there is no process group of its own
+            job = Job(pgid=pid, pids=[pid], cmd=f"@({sub.source})", status='running')
+            self.jobTable.track(job)
+            self.captures += 1
+            return r, thread, job, statuses
+        except BaseException:
+            os.close(r)
+            raise
+        finally:
+            if w is not None:
+                os.close(w)
+
+    def finishCapture(self, capture):
+        r, thread, job, statuses = capture
+        os.close(r)
+        if thread is not None:
+            thread.join()
+        if job is not None:
+            try:
+                while job.live:
+                    self.reaper.wait([job], stops=True)
+                    self.resumeCapture(job)
+            finally:
+                self.captures -= 1
+            statuses[0] = job.codes.get(job.pgid, 0)
+        self.lastStatus = statuses[0]
+
+    def resumeCapture(self, job):
+        # ^Z at the terminal reaches the shell's whole process group, capture
+        # children and whatever they run included. The shell is blocked on
+        # their output, so they are continued rather than left to hang it.
+        if job.status == 'stopped':
+            job.status = 'running'
+            os.killpg(os.getpgrp(), signal.SIGCONT)
+
+    def awaitOutput(self, fd, job):
+        # Blocks until fd is readable. With a terminal around a capture child
+        # can be stopped mid-read, so SIGCHLD is watched for that as well.
+        if job is None or not os.isatty(self.tty_fd):
+            return
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        poller.register(self.reaper.fds[0], select.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            if self.reaper.fds[0] in events:
+                self.reaper.reapAll()
+                self.resumeCapture(job)
+            if fd in events:
+                return
+
+    def readAll(self, fd, job=None):
+        buf = bytearray(CAPTURE_CHUNK)
+        used = 0
+        while True:
+            if used == len(buf):
+                buf.extend(bytes(len(buf)))
+            self.awaitOutput(fd, job)
+            with memoryview(buf) as view, view[used:] as tail:
+                n = os.readv(fd, [tail])
+            if not n:
+                break
+            used += n
+        del buf[used:]
+        return buf
+
     def runIf(self, node):
         conditionIsTrue = False
         conditionNode = node.condition
@@ -357,8 +786,14 @@ class Executor:
             lastStatus = self.run(stmt)
         return lastStatus
 
-    def runFor():
-        pass
+    def runFor(self, node):
+        # The items come from a generator, so a huge glob or a long-running
+        # command feeds the body one item at a time.
+        lastStatus = 0
+        for item in self.expander.iterWords(node.items):
+            self.vars.set(node.var, item)
+            lastStatus = self.run(node.body)
+        return lastStatus
 
     def runWhile(self, node):
         lastStatus = 0
@@ -372,7 +807,22 @@ class Executor:
 
         return lastStatus
 
-    def runCase():
-        pass
+    def runCase(self, node):
+        arm = self.caseMatcher(node).match(self.expander.expandScalar(node.word))
+        if arm is None:
+            return 0
+        return self.run(node.bodies[arm])
+
+    def caseMatcher(self, node):
+        # Compiled once per node; arms with variables only force a recompile
+        # when what they expand to has changed.
+        matcher = getattr(node, "_matcher", None)
+        if matcher is not None and node.static:
+            return matcher
+        arms = tuple(tuple(self.expander.casePattern(p) for p in arm) for arm in node.patterns)
+        if matcher is None or node._arms != arms:
+            node._matcher = Matcher(arms)
+            node._arms = arms
+        return node._matcher
 
     
\ No newline at end of file
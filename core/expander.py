@@ -1,9 +1,34 @@
-import os, glob
-from core.ast import CommandNode, PipeLineNode, BinaryOpNode, AssignmentNode, AssignmentListNode, VarRefNode
+import os, re
+from core.ast import CommandNode, PipeLineNode, BinaryOpNode, AssignmentNode, AssignmentListNode, VarRefNode, SubstitutionNode, ArithmeticNode
+from core.lexer import Lexer, closeParen
+from core.parser import Parser
+from core import arith
+from core.patterns import Globber
+
+DEFAULT_IFS = " \t\n"
+GLOB_CHARS = "*?["
+
+# A word is compiled once into a template, a tuple whose first item is its
+# kind:
+#   (LIT, text)                   needs no expansion at all
+#   (BARE, text, isGlob, tilde)   unquoted word: tilde, IFS split, glob
+#   (VAR, name)                   unquoted @name
+#   (DSTR, segments)              "..." with references; segments are
+#                                 literal strings and (VAR, name),
+#                                 (SUBST, node) or (ARITH, node)
+#   (SUBST, node), (ARITH, node)  @( ... ) and @(( ... ))
+LIT, BARE, VAR, DSTR, SUBST, ARITH = range(6)
+
+SPECIAL_RE = re.compile(r"\\(.)|@", re.S)
+NAME_RE = re.compile(r"[\w?$]*")
 
 class Expander:
     def __init__(self, executor):
         self.executor = executor
+        # templates of words seen so far, and IFS separator regexes
+        self.templates = {}
+        self.separators = {}
+        self.globber = Globber()
 
     def expand(self, node):
         if node is None:
@@ -12,10 +37,15 @@ class Expander:
         tok = node.type.name
         match(tok):
             case "COMMAND":
+                if node.static:
+                    return node
                 return self._expandCommand(node)
             case "PIPELINE":
                 return PipeLineNode("PIPELINE", [self.expand(c) for c in node.cmds], node.background)
             case "BINARYOP":
+                if node.op in ("==", "!=", "<", ">", "<=", ">="):
+                    # operands are words, expanded when compared
+                    return node
                 return BinaryOpNode(node.op, self.expand(node.left), self.expand(node.right))
             case "ASSIGNMENT":
                 return self._expandAssignment(node)
@@ -28,15 +58,28 @@ class Expander:
                 return node
             
     def _expandCommand(self, node: CommandNode) -> CommandNode:
+        # The templates of the name and arguments are kept on the node.
+        plan = getattr(node, "_plan", None)
+        if plan is None:
+            plan = node._plan = (self.compileWord(node.name) if node.name else None,
+                                 [self.compileWord(a) for a in node.args])
+        ifs = self.executor.vars.get("IFS", DEFAULT_IFS)
+
         expandedArgs = []
-        for arg in node.args:
-            expandedArgs.extend(self._expandArg(arg))
+        for t in plan[1]:
+            if t[0] == LIT:
+                expandedArgs.append(t[1])
+            else:
+                expandedArgs.extend(self.expandTemplate(t, ifs))
         
         expandedAssignments = [self._expandAssignment(a) for a in node.assignments]
 
+        # a substituted name may come out as several words, or none
+        words = self.expandTemplate(plan[0], ifs) if plan[0] else []
+
         return CommandNode(
-            name=(self._expandArg(node.name)[0] if node.name else None),
-            args = expandedArgs,
+            name=(words[0] if words else None),
+            args = words[1:] + expandedArgs,
             stdin=self._expandRedir(node.stdin),
             stdout=self._expandRedir(node.stdout),
             stderr=self._expandRedir(node.stderr),
@@ -47,50 +90,228 @@ class Expander:
         )
     
     def _expandAssignment(self,node:AssignmentNode) -> AssignmentNode:
+        local = getattr(node, "local", False)
         if node.value is None:
-            return AssignmentNode(node.name, "")
+            return AssignmentNode(node.name, "", local=local)
+        if isinstance(node.value, ArithmeticNode):
+            # stays an int in the variable store
+            return AssignmentNode(node.name, self.arithmetic(node.value), local=local)
         expanded = self._expandWord(node.value, forAssignment=True)
-        return AssignmentNode(node.name, expanded[0] if expanded else "")
-    
-    def _expandArg(self, arg):
-        if isinstance(arg, dict) and arg.get("type") == "VAR":
-            return self._expandVar(arg["name"])
-        
-        return self._expandWord(arg)
+        return AssignmentNode(node.name, expanded[0] if expanded else "", local=local)
     
     def _expandWord(self, word, forAssignment = False):
+        return self.expandTemplate(self.compileWord(word), self.executor.vars.get("IFS", DEFAULT_IFS), forAssignment)
+
+    def compileWord(self, word):
         if word is None:
-            return [""]
-        if isinstance(word, tuple) and word[0] == "STRING":
-            return [word[1]]
-        
-        if isinstance(word, tuple) and word[0] == "WORD":
-            return [word[1]]
-        
-        if isinstance(word, tuple) and word[0] == "DSTRING":
-            return ["".join(self._expandDString(word[1]))]
-        
-        s = str(word)
-        if not forAssignment and s.startswith("~"):
-            return self._tildeExpand(s)
-        
-        parts = self._fieldSplit(s, os.environ.get("IFS", " \t\n"))
+            return (LIT, "")
+        if isinstance(word, dict):
+            return (VAR, word["name"])
+        if isinstance(word, SubstitutionNode):
+            return (SUBST, word)
+        if isinstance(word, ArithmeticNode):
+            return (ARITH, word)
+        t = self.templates.get(word)
+        if t is None:
+            if isinstance(word, tuple):
+                kind, text = word
+                t = self.compileDString(text) if kind == "DSTRING" else (LIT, text)
+            else:
+                text = str(word)
+                t = (BARE, text, any(c in text for c in GLOB_CHARS), text.startswith("~"))
+            self.templates[word] = t
+        return t
+
+    def compileDString(self, text):
+        # One pass over the string: escapes are resolved and every @
+        # reference becomes a segment; the text between them stays as is.
+        segments = []
+        lit = []
+        pos = 0
+        n = len(text)
+        while True:
+            m = SPECIAL_RE.search(text, pos)
+            if m is None:
+                lit.append(text[pos:])
+                break
+            lit.append(text[pos:m.start()])
+            pos = m.end()
+            if m.group(1) is not None:
+                lit.append(m.group(1))
+                continue
+
+            i = m.start()
+            seg = None
+            if text.startswith("((", i + 1):
+                end = closeParen(text, i + 3)
+                if end > 0 and text.startswith(")", end):
+                    seg = (ARITH, ArithmeticNode(text[i+3:end-1]))
+                    pos = end + 1
+            if seg is None and text.startswith("(", i + 1):
+                end = closeParen(text, i + 2)
+                if end > 0:
+                    source = text[i+2:end-1]
+                    seg = (SUBST, SubstitutionNode(source, Parser(Lexer(source).nextToken()).parse()))
+                    pos = end
+            elif seg is None and text.startswith("{", i + 1):
+                j = text.find("}", i + 2)
+                if j >= 0:
+                    pos = j + 1
+                    if j > i + 2:
+                        seg = (VAR, text[i+2:j])
+            elif seg is None:
+                name = NAME_RE.match(text, i + 1).group()
+                if name:
+                    seg = (VAR, name)
+                    pos = i + 1 + len(name)
+
+            if seg is None:
+                lit.append("@")
+                continue
+            if any(lit):
+                segments.append("".join(lit))
+            lit = []
+            segments.append(seg)
+
+        if any(lit):
+            segments.append("".join(lit))
+        if not any(type(seg) is tuple for seg in segments):
+            return (LIT, "".join(segments))
+        return (DSTR, tuple(segments))
+
+    def expandTemplate(self, t, ifs, forAssignment=False):
+        kind = t[0]
+        if kind == LIT:
+            return [t[1]]
+        if kind == BARE:
+            return self._expandBare(t[1], ifs, forAssignment, t[2], t[3])
+        if kind == VAR:
+            return self._expandVar(t[1], ifs)
+        if kind == DSTR:
+            out = []
+            for seg in t[1]:
+                if type(seg) is str:
+                    out.append(seg)
+                elif seg[0] == VAR:
+                    out.append(self._varValue(seg[1]))
+                elif seg[0] == SUBST:
+                    out.append(self.executor.substitute(seg[1]))
+                else:
+                    out.append(str(self.arithmetic(seg[1])))
+            return ["".join(out)]
+        if kind == SUBST:
+            text = self.executor.substitute(t[1])
+            if forAssignment:
+                return [text]
+            return self.split(text, ifs)
+        return [str(self.arithmetic(t[1]))]
 
+    def _expandBare(self, text, ifs, forAssignment=False, isGlob=None, tilde=None):
+        if tilde is None:
+            tilde = text.startswith("~")
+        if tilde and not forAssignment:
+            return self._tildeExpand(text)
+        # the lexer never puts whitespace in a word, so with the default IFS
+        # there is nothing to split
+        parts = [text] if ifs == DEFAULT_IFS else (self.split(text, ifs) or [""])
+        if isGlob is None:
+            isGlob = any(c in text for c in GLOB_CHARS)
+        if not isGlob:
+            return parts
         out = []
         for p in parts:
-            if any (c in p for c in "*?["):
-                matches = glob.glob(p)
+            if any(c in p for c in GLOB_CHARS):
+                matches = self.globber.glob(p)
                 out.extend(matches if matches else [p])
             else:
                 out.append(p)
         return out
 
+    def split(self, text, ifs):
+        # Fields of text separated by runs of IFS characters.
+        if ifs == DEFAULT_IFS:
+            return text.split()
+        if not ifs:
+            return [text] if text else []
+        sep = self.separators.get(ifs)
+        if sep is None:
+            sep = self.separators[ifs] = re.compile("[" + re.escape(ifs) + "]+")
+        return [f for f in sep.split(text) if f]
+
+    def expandScalar(self, word):
+        # A single word with no field splitting or globbing, as in case.
+        if isinstance(word, dict) and word.get("type") == "VAR":
+            return " ".join(self._expandVar(word["name"]))
+        return self._expandWord(word, forAssignment=True)[0]
+
+    def expandOperand(self, word):
+        # Like expandScalar, but an integer variable or arithmetic result is
+        # returned as an int.
+        if isinstance(word, dict) and word.get("type") == "VAR":
+            value = self.executor.vars.lookup(word["name"])
+            if type(value) is int:
+                return value
+        elif isinstance(word, ArithmeticNode):
+            return self.arithmetic(word)
+        return self.expandScalar(word)
+
+    def arithmetic(self, node):
+        try:
+            fn = getattr(node, "_code", None)
+            if fn is None:
+                fn = node._code = arith.compile(node.expr)
+            return fn(self.executor.vars.lookup)
+        except arith.ArithError as e:
+            raise arith.ArithError(f"@(({node.expr})): {e}") from None
+
+    def casePattern(self, word):
+        # (isGlob, text): quoted patterns match literally.
+        if isinstance(word, tuple):
+            return (False, self._expandWord(word)[0])
+        text = self.expandScalar(word) if isinstance(word, dict) else word
+        return (any(c in text for c in "*?["), text)
+
+    def iterWords(self, words):
+        # Lazy counterpart of expanding each word with _expandWord: matches of
+        # a glob and fields of command output are produced one at a time.
+        for word in words:
+            if isinstance(word, SubstitutionNode):
+                yield from self._iterFields(self.executor.iterOutput(word))
+            elif isinstance(word, str) and not word.startswith("~") and any(c in word for c in "*?["):
+                for p in self.split(word, self.executor.vars.get("IFS", DEFAULT_IFS)) or [""]:
+                    matched = False
+                    for path in self.globber.iglob(p):
+                        matched = True
+                        yield path
+                    if not matched:
+                        yield p
+            else:
+                yield from self._expandWord(word)
+
+    def _iterFields(self, chunks):
+        ifs = self.executor.vars.get("IFS", DEFAULT_IFS)
+        if not ifs:
+            data = b"".join(chunks).rstrip(b"\n")
+            if data:
+                yield data.decode(errors="replace")
+            return
+        sep = re.compile(b"[" + re.escape(ifs.encode()) + b"]+")
+        rest = b""
+        for chunk in chunks:
+            fields = sep.split(rest + chunk)
+            rest = fields.pop()
+            for f in fields:
+                if f:
+                    yield f.decode(errors="replace")
+        if rest:
+            yield rest.decode(errors="replace")
+
     def _expandRedir(self, target):
         if not target:
             return None
         return self._expandWord(target, forAssignment=True)[0]
     
-    def _expandVar(self, name, seen=None):
+    def _expandVar(self, name, ifs=None, seen=None):
         if seen is None:
             seen = set()
         if name in seen:
@@ -98,95 +319,43 @@ class Expander:
         seen.add(name)
 
         if name == "?":
-            return [str(getattr(self.executor, "last_status", 0))]
+            return [str(self.executor.lastStatus)]
         if name in ("$", "$$"):
             return [str(os.getpid())]
 
-        raw = os.environ.get(name, "")
+        raw = self.executor.vars.get(name)
         if raw == "":
             return [""]
 
+        if ifs is None:
+            ifs = self.executor.vars.get("IFS", DEFAULT_IFS)
+        if ifs == DEFAULT_IFS and not any(c in raw for c in "@~*?["):
+            return raw.split()
         parts = []
         for token in raw.split():
             if token.startswith("@"):        
                 inner = token[1:]
-                parts.extend(self._expandVar(inner, seen))
+                parts.extend(self._expandVar(inner, ifs, seen))
             else:
-                parts.extend(self._expandWord(token))
+                parts.extend(self._expandBare(token, ifs))
         return parts
-    
-    def _expandVarFrag(self, frag: str):
-        return [os.environ.get(frag, "")]
-    
-    def _expandDString(self, text: str) -> str:
-        out = []
-        i, n = 0, len(text)
-        while i < n:
-            ch = text[i]
-
-            if ch == "\\" and i + 1 < n:
-                out.append(text[i+1])
-                i += 2
-                continue
-
-            if ch == "@":
-                if i + 1 < n and text[i+1] == "{":
-                    j = i + 2
-                    while j < n and text[j] != "}":
-                        j += 1
-                    if j < n:
-                        name = text[i+2:j]
-                        i = j + 1
-                    else:
-                        out.append("@")
-                        i += 1
-                        continue
-                else:
-                    j = i + 1
-                    while j < n and (text[j].isalnum() or text[j] == "_" or text[j] in ("?", "$")):
-                        j += 1
-                    name = text[i+1:j]
-                    i = j
-
-                if not name:
-                    out.append("@")
-                    continue
-
-                if name == "?":
-                    val = str(getattr(self.executor, "last_status", 0))
-                elif name in ("$", "$$"):
-                    val = str(os.getpid())
-                else:
-                    val = os.environ.get(name, "")
 
-                out.append(val)
-            else:
-                out.append(ch)
-                i += 1
-        return "".join(out)
-            
-    def _fieldSplit(self, s:str, ifs:str):
-        parts, buf = [], ""
-        for ch in s:
-            if ch in ifs:
-                if buf:
-                    parts.append(buf)
-                    buf = ""
-            else:
-                buf += ch
-        if buf:
-            parts.append(buf)
-        return parts if parts else [""]
+    def _varValue(self, name):
+        if name == "?":
+            return str(self.executor.lastStatus)
+        if name in ("$", "$$"):
+            return str(os.getpid())
+        return self.executor.vars.get(name)
             
     def _tildeExpand(self, s:str):
         if s == "~" or s.startswith("~/"):
-            return [(os.environ.get("HOME") or os.path.expanduser("~")) + s[1:]]
+            return [(self.executor.vars.get("HOME") or os.path.expanduser("~")) + s[1:]]
         if s.startswith("~"):
             user = s[1:].split("/", 1)[0]
             rest = s[len(user)+1:]
             import pwd
             try:
-                return pwd.getpwnam(user).pw_dir + rest
+                return [pwd.getpwnam(user).pw_dir + rest]
             except KeyError:
                 return [s]
         return [s]
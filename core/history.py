@@ -0,0 +1,152 @@
+import os, re, time, queue, threading
+
+# Interactive command history.
+#
+# Each command is appended to the history file as one line by a writer
+# thread through an O_APPEND fd, so a prompt never waits on the disk and
+# shells sharing the file don't overwrite each other. Once the file holds
+# more than twice RAYSHELL_HISTFILESIZE lines the writer rewrites it down to
+# the newest RAYSHELL_HISTFILESIZE. At startup only the newest
+# RAYSHELL_HISTSIZE lines are read, from the end of the file.
+#
+# With RAYSHELL_HISTMETA set, commands are stored with their start time,
+# exit status and duration in ms, zsh style:
+#
+#   : 1760000000:0:12;make -j8
+#
+# Plain and annotated lines can be mixed in one file.
+
+HISTFILE = "~/.rayshell_history"
+HISTSIZE = 1000
+HISTFILESIZE = 10000
+BLOCK = 1 << 16
+
+META_RE = re.compile(r": (\d+):(-?\d+):(\d+);(.*)\Z", re.S)
+
+def setting(environ, name, default):
+    try:
+        return int(environ.get(name, default))
+    except ValueError:
+        return default
+
+def parseLine(line):
+    # (command, (start, status, ms)) or (command, None) for a plain line.
+    m = META_RE.match(line)
+    if m is None:
+        return line, None
+    return m.group(4), (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+
+def formatLine(command, meta):
+    command = command.replace("\n", " ")
+    if meta is None:
+        return command + "\n"
+    start, status, ms = meta
+    return f": {start}:{status}:{ms};{command}\n"
+
+def tail(path, n):
+    # The last n lines of path, reading backwards a block at a time.
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return []
+    with f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.split(b"\n")
+    if pos > 0:
+        lines = lines[1:]
+    return [l.decode(errors="replace") for l in lines if l][-n:] if n > 0 else []
+
+def countLines(fd):
+    count = 0
+    os.lseek(fd, 0, os.SEEK_SET)
+    while chunk := os.read(fd, BLOCK):
+        count += chunk.count(b"\n")
+    return count
+
+class History:
+    def __init__(self, environ=os.environ):
+        self.path = os.path.expanduser(environ.get("RAYSHELL_HISTFILE", HISTFILE))
+        self.size = setting(environ, "RAYSHELL_HISTSIZE", HISTSIZE)
+        self.fileSize = setting(environ, "RAYSHELL_HISTFILESIZE", HISTFILESIZE)
+        self.meta = bool(environ.get("RAYSHELL_HISTMETA"))
+        # entries[i] is command number first + i
+        self.entries = []
+        self.first = 1
+        self.pending = queue.Queue()
+        self.writer = None
+
+    def load(self):
+        self.entries = [parseLine(line) for line in tail(self.path, self.size)]
+        return [command for command, _ in self.entries]
+
+    def add(self, command, status=0, started=None):
+        if not command.strip():
+            return
+        meta = None
+        if self.meta and started is not None:
+            meta = (int(started), status, int((time.time() - started) * 1000))
+        self.entries.append((command, meta))
+        if len(self.entries) > 2 * self.size:
+            drop = len(self.entries) - self.size
+            del self.entries[:drop]
+            self.first += drop
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.writeLoop, daemon=True)
+            self.writer.start()
+        self.pending.put(formatLine(command, meta))
+
+    def last(self, n=None):
+        # [(number, command, meta)] for the newest n entries, oldest first.
+        start = 0 if n is None else max(len(self.entries) - n, 0)
+        return [(self.first + i, command, meta)
+                for i, (command, meta) in enumerate(self.entries[start:], start)]
+
+    def close(self):
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join(timeout=2)
+            self.writer = None
+
+    def open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        return fd, countLines(fd)
+
+    def writeLoop(self):
+        try:
+            fd, lines = self.open()
+        except OSError as e:
+            print(f"error opening history {e}")
+            return
+        try:
+            while (line := self.pending.get()) is not None:
+                # Another shell may have compacted the file under us.
+                try:
+                    if os.stat(self.path).st_ino != os.fstat(fd).st_ino:
+                        os.close(fd)
+                        fd, lines = self.open()
+                    os.write(fd, line.encode())
+                    lines += 1
+                    if lines > 2 * self.fileSize:
+                        os.close(fd)
+                        self.compact()
+                        fd, lines = self.open()
+                except OSError as e:
+                    print(f"error writing history {e}")
+        finally:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def compact(self):
+        keep = tail(self.path, self.fileSize)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.writelines(line + "\n" for line in keep)
+        os.replace(tmp, self.path)
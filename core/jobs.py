@@ -1,42 +1,117 @@
+import os
+
+# background exit codes remembered after their jobs are collected
+MAXSTATUSES = 1024
+
 class Job:
-    def __init__(self, pgid, pids, cmd, status='running'):
+    def __init__(self, pgid, pids, cmd, status='running', background=False):
         self.pgid = pgid
         self.pids = pids
         self.cmd = cmd
         self.status = status 
+        # a finished background job stays in the table until it is collected
+        self.background = background
+        self.id = None
+        self.live = len(pids)
+        self.codes = {}
+        # when it last finished or stopped, counted in reaped events; orders
+        # jobs by completion
+        self.settled = None
 
 class JobTable:
+    # Jobs are indexed by job number, pgid and every pid, so reaping a child
+    # is a dict lookup no matter how many jobs are running. Job numbers stay
+    # put when earlier jobs finish; a new job gets the highest number + 1.
     def __init__(self):
-        self.jobs = []
+        self.jobs = {}
+        self.byPid = {}
+        self.byPgid = {}
+        self.nextId = 1
+        # exit codes of background pids collected by a job notification, so
+        # a later `wait PID` still gets them
+        self.statuses = {}
+        self.events = 0
 
     def add(self, job: Job):
-        self.jobs.append(job)
+        job.id = self.nextId
+        self.nextId += 1
+        self.jobs[job.id] = job
+        self.byPgid[job.pgid] = job
+        for pid in job.pids:
+            self.byPid[pid] = job
+
+    def track(self, job: Job):
+        # The shell's own command substitutions: reaped like any job, but
+        # with no job number, so jobs, wait, fg and bg never see them.
+        self.byPgid[job.pgid] = job
+        for pid in job.pids:
+            self.byPid[pid] = job
 
     def get_by_index(self, idx):
-    
+        return self.jobs.get(idx)
+
+    def current(self):
         if not self.jobs:
             return None
-        if 1 <= idx <= len(self.jobs):
-            return self.jobs[idx - 1]
-        return None
+        return self.jobs[next(reversed(self.jobs))]
 
     def remove(self, pgid):
-        self.jobs = [j for j in self.jobs if j.pgid != pgid]
+        job = self.byPgid.pop(pgid, None)
+        if job is None:
+            return
+        self.jobs.pop(job.id, None)
+        for pid in job.pids:
+            if self.byPid.get(pid) is job:
+                del self.byPid[pid]
+        self.nextId = next(reversed(self.jobs)) + 1 if self.jobs else 1
     
     def getByPid(self, pid):
-        for job in self.jobs:
-            if pid in job.pids:
-                return job
-        return None
+        return self.byPid.get(pid)
 
     def getByPgid(self, pgid):
-        for job in self.jobs:
-            if job.pgid == pgid:
-                return job
-        return None
+        return self.byPgid.get(pgid)
 
     def list(self):
-        return self.jobs
+        return list(self.jobs.values())
+
+    def collect(self, job):
+        # A finished job is done with: forget it, remembering its exit codes.
+        if job.background:
+            self.statuses.update(job.codes)
+            while len(self.statuses) > MAXSTATUSES:
+                del self.statuses[next(iter(self.statuses))]
+        self.remove(job.pgid)
+
+    def finished(self):
+        return [job for job in self.jobs.values() if job.status == 'done']
+
+    def reap(self, pid, status):
+        # Record a waitpid() result. A foreground job leaves the table once
+        # its last live pid has exited; a background one is kept, with its
+        # codes, until wait or a job notification collects it.
+        job = self.byPid.get(pid)
+        if job is None:
+            return None
+        if os.WIFSTOPPED(status):
+            job.status = 'stopped'
+            self.settle(job)
+        elif os.WIFCONTINUED(status):
+            job.status = 'running'
+        elif os.WIFEXITED(status) or os.WIFSIGNALED(status):
+            job.codes[pid] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+            if not job.background:
+                del self.byPid[pid]
+            job.live -= 1
+            if job.live == 0:
+                job.status = 'done'
+                self.settle(job)
+                if not job.background:
+                    self.remove(job.pgid)
+        return job
+
+    def settle(self, job):
+        self.events += 1
+        job.settled = self.events
 
     def markStopped(self, pgid):
         job = self.getByPgid(pgid)
@@ -1,4 +1,5 @@
 from enum import Enum
+import re
 
 class TokenType(Enum):
     WORD = "WORD"
@@ -31,6 +32,10 @@ class TokenType(Enum):
     ARROW = "ARROW"
     LBRACE = "LBRACE"
     RBRACE = "RBRACE"
+    SUBST = "SUBST"
+    ARITH = "ARITH"
+    PLUS_EQ = "PLUS_EQ"
+    MINUS_EQ = "MINUS_EQ"
 
 OPERATORS = {
     # "@": TokenType.VAR,
@@ -47,6 +52,8 @@ OPERATORS = {
     "<=": TokenType.LT_EQ,
     "==": TokenType.EQ_EQ,
     "!=": TokenType.NOT_EQ,
+    "+=": TokenType.PLUS_EQ,
+    "-=": TokenType.MINUS_EQ,
     ";":TokenType.SEMICOLON,
     "=": TokenType.EQ,
     "|": TokenType.PIPE,
@@ -60,177 +67,217 @@ OPERATORS = {
     '\n':TokenType.NEWLINE,
 }
 
+# Longest operator first, so "2>>" wins over "2>" and ">>" over ">".
+OPERATOR_PATTERN = "|".join(re.escape(op) for op in sorted(OPERATORS, key=len, reverse=True) if op != "\n")
+
+# One alternative per kind of lexeme; the catch-all "error" branch only fires
+# on an unterminated quote or a malformed variable reference. A word is a run
+# of characters that cannot start anything else: "2" begins an operator only
+# when followed by ">", "-" when followed by ">" or "=", "+" and "!" when
+# followed by "=".
+SCANNER_RE = re.compile(r"""
+    (?P<word>(?:[^\s'"@$><&|=;{}()2\-+!\#]|2(?!>)|-(?![>=])|\+(?!=)|!(?!=))(?:[^\s'"@$><&|=;{}()2\-+!]|2(?!>)|-(?![>=])|\+(?!=)|!(?!=))*)
+  | (?P<blank>[^\S\n]+)
+  | (?P<newline>\n)
+  | (?P<op>""" + OPERATOR_PATTERN + r""")
+  | (?P<subst>[@$]\()
+  | (?P<var>[@$]\w+)
+  | (?P<dstring>"(?:[^"\\]|\\[\s\S])*")
+  | (?P<string>'(?:[^'\\]|\\[\s\S])*')
+  | (?P<bracedvar>[@$]\{[^}]*\})
+  | (?P<comment>\#[^\n]*\n?)
+  | (?P<error>[\s\S])
+""", re.VERBOSE)
+ESCAPE_RE = re.compile(r"\\([\s\S])")
+# Inside @( ... ): quotes and escapes, which may hide a paren, the parens, and
+# a quote left open.
+SUBST_RE = re.compile(r"""'(?:[^'\\]|\\[\s\S])*'|"(?:[^"\\]|\\[\s\S])*"|\\[\s\S]|[()'"]""")
+
+CHUNKSIZE = 1 << 16
+
+def closeParen(src, pos, end=None):
+    # Index just past the ")" matching a "(" that ends right before pos, or
+    # -1 if src runs out first.
+    depth = 1
+    for m in SUBST_RE.finditer(src, pos, len(src) if end is None else end):
+        c = m.group()
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if not depth:
+                return m.end()
+        elif c in "'\"":
+            return -1
+    return -1
+
 class Token:
-    def __init__(self, type_, value=None, line=0, col=0):
+    # line is the lexer's historical line count; physLine is the 0-based line
+    # of the source the token is really on, for the profiler.
+    __slots__ = ("type", "value", "line", "col", "physLine")
+
+    def __init__(self, type_, value=None, line=0, col=0, physLine=None):
         self.type = type_
         self.value = value
         self.line = line
         self.col = col
+        self.physLine = line if physLine is None else physLine
 
     def __repr__(self):
         return (f"{self.type}, Value: {self.value}, Line:{self.line} Col:{self.col}")
     
 class Lexer:
-    def __init__(self, line):
+    def __init__(self, line="", reader=None):
         self.line = line
         self.length = len(line)
+        self.reader = reader
         self.pos:int = 0
         self.lineNo:int = 0
+        # newlines inside comments and quotes, which lineNo leaves out
+        self.skew = 0
         self.colNo = 0
         self.tokens = []
 
-    def readChar(self):
-        if self.pos >= self.length:
-            return None
-        ch = self.line[self.pos]
-        self.pos+=1
-        # if ch == "\n":
-            # self.lineNo+=1
-            # self.colNo = 0
-        # else:
-        self.colNo+=1
-        return ch
-    
-    def peekChar(self, offset=0):
-        idx = self.pos + offset
-        if idx >= self.length:
-            return None
-        return self.line[idx]
-    
-    def finalizeBuffer(self, buf):
-        if not buf:
-            return
-        # if buf.upper() in RESERVEDWORDS:
-        #     self.addToken(RESERVEDWORDS[buf.upper()], buf.upper())
-        # else:
-        self.addToken(TokenType.WORD, buf)    
-    
-    def addToken(self, type_, value= None):
-        self.tokens.append(Token(type_, value, self.lineNo, self.colNo))
-    
     def nextToken(self):
-        
+        self.pos = self.scan(self.line, self.pos, True, self.tokens)
+        return self.tokens
+
+    def iterTokens(self):
+        if self.reader is None:
+            yield from self.nextToken()
+            return
         buf = ""
         while True:
-            ch = self.readChar()
-            # if ch == "\\":
-            #     nextCh = self.peekChar()
-            #     if nextCh is None:
-            #         buf += ch
-            #         continue
-
-            #     self.readChar()
-            #     if nextCh == "n":
-            #         ch = '\n'
-
-            #     else:
-            #         ch = nextCh
-
-            if ch is None:
-                self.finalizeBuffer(buf)
-                buf = ""
-                self.addToken(TokenType.EOF)
-                break
-
-            if ch == "#" and not buf:
-                while ch is not None and ch != "\n":
-                    ch = self.readChar()
-                continue
-
-            if ch.isspace():
-                self.finalizeBuffer(buf)
-                buf = ""
-                if ch == "\n":
-                    self.lineNo+=1
-                    self.colNo = 0
-                    self.addToken(TokenType.NEWLINE)
-                continue
-
-            if ch == "'":
-                buf = ""
-                while True:
-                    ch2 = self.readChar()
-                    if ch2 is None:
-                        raise ValueError("Quotes must be closed!")
-                    if ch2 == "'":
-                        break
-                    if ch2 == "\\":
-                        nextCh = self.readChar()
-                        buf += nextCh or ""
+            chunk = self.reader.read(CHUNKSIZE)
+            buf += chunk
+            out = []
+            end = self.scan(buf, 0, not chunk, out)
+            yield from out
+            if not chunk:
+                return
+            buf = buf[end:]
+
+    def scan(self, src, pos, final, tokens):
+        # Columns count characters consumed since the last newline token, and
+        # every token is stamped with the position just after the character
+        # that completed it. Comments swallow their newline without starting
+        # a new line, and a word directly followed by a quote or a variable is
+        # dropped; both are long-standing behaviours that scripts depend on.
+        # physLine counts every newline, including those.
+        #
+        # Unless final, more input may follow src: only whole lines are
+        # scanned, and a quote or braced variable left open at the end is
+        # retried once the next chunk has been appended. The index to resume
+        # from is returned.
+        n = len(src)
+        if not final:
+            n = src.rfind("\n", pos) + 1
+            if n == 0:
+                return pos
+        append = tokens.append
+        lineNo = self.lineNo
+        skew = self.skew
+        lineStart = pos - self.colNo
+        word = None
+        wordStart = pos
+        WORD, NEWLINE, VAR = TokenType.WORD, TokenType.NEWLINE, TokenType.VAR
+
+        resume = pos
+        while resume is not None:
+            start, resume = resume, None
+            for m in SCANNER_RE.finditer(src, start, n):
+                kind = m.lastgroup
+                if kind == "word":
+                    word = m.group()
+                    wordStart = m.start()
+                    continue
+
+                pos = m.start()
+                if kind == "blank":
+                    if word is not None:
+                        append(Token(WORD, word, lineNo, pos + 1 - lineStart, lineNo + skew))
+                        word = None
+                elif kind == "newline":
+                    if word is not None:
+                        append(Token(WORD, word, lineNo, pos + 1 - lineStart, lineNo + skew))
+                        word = None
+                    lineNo += 1
+                    lineStart = pos + 1
+                    append(Token(NEWLINE, None, lineNo, 0, lineNo + skew))
+                elif kind == "op":
+                    if word is not None:
+                        append(Token(WORD, word, lineNo, pos + 1 - lineStart, lineNo + skew))
+                        word = None
+                    op = m.group()
+                    append(Token(OPERATORS[op], op, lineNo, m.end() - lineStart, lineNo + skew))
+                elif kind == "subst":
+                    end = closeParen(src, m.end(), n)
+                    if end < 0:
+                        if not final:
+                            pos = wordStart if word is not None else pos
+                            self.lineNo = lineNo
+                            self.skew = skew
+                            self.colNo = pos - lineStart
+                            return pos
+                        raise ValueError("Command substitution must be closed!")
+                    word = None
+                    body = src[m.end():end - 1]
+                    if "\n" in body:
+                        lineNo += body.count("\n")
+                        lineStart = src.rfind("\n", pos, end) + 1
+                    if body.startswith("(") and closeParen(src, m.end() + 1, n) == end - 1:
+                        # @(( ... )): arithmetic rather than a substitution
+                        append(Token(TokenType.ARITH, body[1:-1], lineNo, end - lineStart, lineNo + skew))
                     else:
-                        buf += ch2
-                self.addToken(TokenType.STRING, buf)
-                buf = ""
-                continue
-
-            if ch == '"':
-                buf = ""
-                while True:
-                    ch2 = self.readChar()
-                    if ch2 is None:
+                        append(Token(TokenType.SUBST, body, lineNo, end - lineStart, lineNo + skew))
+                    # the body may hold anything; pick the scan up after it
+                    resume = end
+                    break
+                elif kind == "var":
+                    word = None
+                    append(Token(VAR, m.group()[1:], lineNo, m.end() - lineStart, lineNo + skew))
+                elif kind == "dstring" or kind == "string":
+                    word = None
+                    body = m.group()[1:-1]
+                    if "\n" in body:
+                        skew += body.count("\n")
+                    if "\\" in body:
+                        body = ESCAPE_RE.sub(r"\1", body)
+                    append(Token(TokenType.DSTRING if kind == "dstring" else TokenType.STRING, body, lineNo, m.end() - lineStart, lineNo + skew))
+                elif kind == "bracedvar":
+                    word = None
+                    name = m.group()[2:-1]
+                    if not name:
+                        raise ValueError("Variable name expected!")
+                    append(Token(VAR, name, lineNo, m.end() - lineStart, lineNo + skew))
+                elif kind == "comment":
+                    if m.group().endswith("\n"):
+                        skew += 1
+                elif kind == "error":
+                    ch = m.group()
+                    if not final and (ch in "'\"" or src.startswith("{", pos + 1)):
+                        pos = wordStart if word is not None else pos
+                        self.lineNo = lineNo
+                        self.skew = skew
+                        self.colNo = pos - lineStart
+                        return pos
+                    if ch in "'\"":
                         raise ValueError("Quotes must be closed!")
-                    if ch2 == '"':
-                        break
-                    if ch2 == "\\":
-                        nextCh = self.readChar()
-                        buf += nextCh or ""
-                    else:
-                        buf += ch2
-                self.addToken(TokenType.DSTRING, buf)
-                buf = ""
-                continue
-
-            if ch in ("@", "$") and self.peekChar() == "{":
-                self.readChar()
-                buf = ""
-                while True:
-                    nextCh = self.readChar()
-                    if nextCh is None:
+                    if src.startswith("{", pos + 1):
                         raise ValueError("Unclosed variable braced!")
-                    if nextCh == "}":
-                        break
-                    buf += nextCh
-                if not buf:
                     raise ValueError("Variable name expected!")
-                self.addToken(TokenType.VAR, buf)
-                buf = ""
-                continue
-
-            if ch in ("@", "$"):
-                buf = ""
-                line, col = self.lineNo, self.colNo
-                while True:
-                    nextCh = self.peekChar()
-                    if nextCh is not None and (nextCh.isalnum() or nextCh == "_"):
-                        buf += self.readChar()
-                    else:
-                        break
-                if not buf:
-                    raise ValueError("Variable name expected!")
-                self.addToken(TokenType.VAR, buf)
-                buf=""
-                continue
-                
-            three = ch + (self.peekChar(0) or "") + (self.peekChar(1) or "")
-            two = ch + (self.peekChar() or "")
-            if three in OPERATORS:
-                self.finalizeBuffer(buf)
-                buf = ""
-                self.readChar()
-                self.readChar()
-                self.addToken(OPERATORS[three], three)
-                continue
-            if two in OPERATORS:
-                self.finalizeBuffer(buf)
-                buf = ""
-                self.readChar()
-                self.addToken(OPERATORS[two], two)
-                continue
-            if ch in OPERATORS:
-                self.finalizeBuffer(buf)
-                buf = ""
-                self.addToken(OPERATORS[ch], ch)
-                continue
-
-            buf+=ch
-        return self.tokens
\ No newline at end of file
+
+        if not final:
+            self.lineNo = lineNo
+            self.skew = skew
+            self.colNo = n - lineStart
+            return n
+
+        if word is not None:
+            append(Token(WORD, word, lineNo, n - lineStart, lineNo + skew))
+        append(Token(TokenType.EOF, None, lineNo, n - lineStart, lineNo + skew))
+
+        self.lineNo = lineNo
+        self.skew = skew
+        self.colNo = n - lineStart
+        return n
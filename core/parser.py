@@ -1,18 +1,47 @@
+import re
 from core.lexer import Lexer, TokenType, Token
 from enum import Enum
-from core.ast import CommandNode, PipeLineNode, BinaryOpNode, AssignmentNode, AssignmentListNode, VarRefNode, IfNode, BlockNode, WhileNode
-    
+from core.ast import CommandNode, PipeLineNode, BinaryOpNode, AssignmentNode, AssignmentListNode, VarRefNode, IfNode, BlockNode, WhileNode, SubstitutionNode, ForNode, CaseNode, ArithmeticNode, FunctionNode
+
+# Bump whenever the parser or the AST node layout changes; it invalidates
+# every cached parse (see core/astcache.py).
+GRAMMAR_VERSION = 11
+
+COMPARISONS = (TokenType.EQ_EQ, TokenType.NOT_EQ, TokenType.LT, TokenType.GT, TokenType.LT_EQ, TokenType.GT_EQ)
+
+# < and > are also redirections: `cmd > file` stays a command unless the left
+# side could never name one
+REDIRECTING = (TokenType.LT, TokenType.GT)
+NUMBER = re.compile(r"-?\d+(\.\d+)?")
+
 class Parser:
     def __init__(self, tokens):
-        self.tokens = tokens
+        # A list is parsed in place; any other iterable is pulled from lazily
+        # so statements() can hand out each statement as soon as it is whole.
+        if isinstance(tokens, list):
+            self.tokens = tokens
+            self.source = None
+        else:
+            self.tokens = []
+            self.source = iter(tokens)
         self.pos = 0
         self.context = "TOPLEVEL"
     
         self.RESERVED = {
-            "if", "for", "case", "while", "elif", "else"
+            "if", "for", "case", "while", "elif", "else", "fn"
         }
 
+    def fill(self, idx):
+        while idx >= len(self.tokens) and self.source is not None:
+            tok = next(self.source, None)
+            if tok is None:
+                self.source = None
+            else:
+                self.tokens.append(tok)
+
     def peek(self):
+        if self.pos >= len(self.tokens):
+            self.fill(self.pos)
         if self.pos < len(self.tokens):
             return self.tokens[self.pos]
         return Token(TokenType.EOF, None)
@@ -23,6 +52,7 @@ class Parser:
     
     def peekN(self, n:int):
         idx = self.pos + n
+        self.fill(idx)
         if 0 <= idx < len(self.tokens):
             return self.tokens[idx]
         return Token(TokenType.EOF, None)
@@ -33,10 +63,11 @@ class Parser:
         return tok
     
     def isAssignmentLookAhead(self) -> bool:
-        return (self.peek().type == TokenType.WORD and self.peekN(1).type == TokenType.EQ)
+        return (self.peek().type == TokenType.WORD and
+                self.peekN(1).type in (TokenType.EQ, TokenType.PLUS_EQ, TokenType.MINUS_EQ))
     
     def isCommandStart(self, tok) -> bool:
-        return tok.type in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING)
+        return tok.type in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING, TokenType.SUBST, TokenType.ARITH)
     
     def isRedirection(self, tok) -> bool:
         return tok.type in (
@@ -48,14 +79,7 @@ class Parser:
         )
     
     def parse(self):
-        self._consumeSeparators
-        statements = []
-        
-        while self.peek().type != TokenType.EOF:
-            node = self.parseSequence()
-            if node:
-                statements.append(node)
-            self._consumeSeparators()
+        statements = list(self.statements())
 
         if not statements:
             return None
@@ -64,7 +88,40 @@ class Parser:
             return statements[0]
         return BlockNode(statements)
     
+    def statements(self):
+        self._consumeSeparators()
+        while self.peek().type != TokenType.EOF:
+            start = self.pos
+            node = self.parseSequence()
+            if node is None and self.pos == start:
+                tok = self.peek()
+                raise SyntaxError(f"Unexpected token '{tok.value}', line={tok.line} col={tok.col}")
+            if self.source is not None:
+                # the statement is done with its tokens; don't hold on to them
+                del self.tokens[:self.pos]
+                self.pos = 0
+            if node:
+                yield node
+            self._consumeSeparators()
+
     def parseSequence(self):
+        node = self.parseStatement()
+        while self.peek().type == TokenType.SEMICOLON:
+            self.advance()
+            right = self.parseStatement()
+            if right is not None:
+                node = right if node is None else BinaryOpNode(";", node, right)
+        return node
+
+    def parseStatement(self):
+        # Statements remember their 1-based source line, for the profiler.
+        line = self.peek().physLine + 1
+        node = self.parseBareStatement()
+        if node is not None:
+            node.line = line
+        return node
+
+    def parseBareStatement(self):
         tok = self.peek()
         if tok.type == TokenType.WORD and tok.value in self.RESERVED:
             self.advance()
@@ -76,12 +133,10 @@ class Parser:
                 case "FOR": return self.parseFor()
                 case "WHILE": return self.parseWhile()
                 case "CASE": return self.parseCase()
-        node = self.parseLogical()
-        while self.peek().type == TokenType.SEMICOLON:
-            self.advance()
-            right = self.parseLogical()
-            node = BinaryOpNode(";", node, right)
-        return node
+                case "FN": return self.parseFunction()
+        if tok.type == TokenType.WORD and tok.value == "local" and self.peekN(1).type == TokenType.WORD:
+            return self.parseLocal()
+        return self.parseLogical()
 
     def parseLogical(self):
         node = self.parsePipeLine()
@@ -105,13 +160,26 @@ class Parser:
     
     def parseAssignment(self):
         varName = self.advance().value
-        self.advance()
-        if self.peek().type in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING):
+        op = self.advance()
+        if op.type != TokenType.EQ:
+            # name+=value is name = @((name + (value)))
+            tok = self.peek()
+            if tok.type == TokenType.VAR:
+                operand = "@{" + tok.value + "}"
+            elif tok.type in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING, TokenType.ARITH):
+                operand = tok.value
+            else:
+                raise SyntaxError(f"Expected a value after '{op.value}', line={tok.line} col={tok.col}")
+            self.advance()
+            return AssignmentNode(varName, ArithmeticNode(f"{varName} {op.value[0]} ({operand})"))
+        if self.isCommandStart(self.peek()):
             t = self.advance()
             if t.type == TokenType.STRING:
                 varValue = ("STRING", t.value)
             elif t.type == TokenType.DSTRING:
                 varValue = ("DSTRING", t.value)
+            elif t.type in (TokenType.SUBST, TokenType.ARITH):
+                varValue = self.word(t)
             else:
                 varValue = ("WORD", t.value)
         else:
@@ -120,23 +188,24 @@ class Parser:
     
     def parseRedirection(self, redir):
         tok = self.advance()
-        if self.peek().type not in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING):
+        if not self.isCommandStart(self.peek()):
             raise ValueError ("File name required after redirection!")
         
         target = self.advance()
+        target = self.word(target) if target.type in (TokenType.SUBST, TokenType.ARITH) else target.value
         
         match tok.type:
             case TokenType.LT:
-                redir['stdin'] = target.value
+                redir['stdin'] = target
             case TokenType.GT:
-                redir['stdout'] = target.value
+                redir['stdout'] = target
             case TokenType.APPEND_OUT:
-                redir['stdout'] = target.value
+                redir['stdout'] = target
                 redir['stdoutAppend'] = True
             case TokenType.REDIR_ERR:
-                redir['stderr'] = target.value
+                redir['stderr'] = target
             case TokenType.APPEND_ERR:
-                redir['stderr'] = target.value
+                redir['stderr'] = target
                 redir['stderrAppend'] = True
             case _:
                 raise SyntaxError("No such Redirection type!")  
@@ -178,12 +247,21 @@ class Parser:
                     cmd = ("STRING", tok.value)
                 elif tok.type == TokenType.DSTRING:
                     cmd = ("DSTRING", tok.value)
+                elif tok.type in (TokenType.SUBST, TokenType.ARITH):
+                    cmd = self.word(tok)
                 else: 
                     cmd = ("WORD", tok.value)
                 self.context = "COMMANDARG"
             elif self.isCommandStart(self.peek()) and cmd is not None:
                 tok = self.advance()
-                args.append(tok.value)
+                if tok.type == TokenType.STRING:
+                    args.append(("STRING", tok.value))
+                elif tok.type == TokenType.DSTRING:
+                    args.append(("DSTRING", tok.value))
+                elif tok.type in (TokenType.SUBST, TokenType.ARITH):
+                    args.append(self.word(tok))
+                else:
+                    args.append(tok.value)
             else: 
                 break
 
@@ -198,6 +276,11 @@ class Parser:
         if not cmd and not assignments and not any (redir.values()):
             return None
         
+        static = self.literalCommand(cmd, args, redir, assignments)
+        if static:
+            args = [self.literal(a) for a in args]
+            assignments = [AssignmentNode(a.name, self.literal(a.value) if a.value else "") for a in assignments]
+
         return CommandNode(name = cmd, 
                         args = args, stdin=redir['stdin'],
                         stdout=redir['stdout'],
@@ -205,7 +288,38 @@ class Parser:
                         stderr=redir['stderr'],
                         stderrAppend=redir['stderrAppend'],
                         assignments=assignments,
-                        background=background)  
+                        background=background,
+                        static=static)
+
+    def substitution(self, tok):
+        return SubstitutionNode(tok.value, Parser(Lexer(tok.value).nextToken()).parse())
+
+    def literal(self, word):
+        # The value a word expands to if it needs no expansion, else None.
+        if isinstance(word, tuple):
+            kind, value = word
+            if kind == "DSTRING" and ("@" in value or "\\" in value):
+                return None
+            return value
+        if isinstance(word, str):
+            if word.startswith("~") or any(c in word for c in "*?["):
+                return None
+            return word
+        return None
+
+    def literalCommand(self, cmd, args, redir, assignments):
+        if cmd is None or self.literal(cmd) is None:
+            return False
+        for word in args:
+            if self.literal(word) is None:
+                return False
+        for key in ("stdin", "stdout", "stderr"):
+            if redir[key] and self.literal(redir[key]) is None:
+                return False
+        for a in assignments:
+            if a.value and self.literal(a.value) is None:
+                return False
+        return True
 
     def parseIf(self):
         # self.advance()
@@ -244,17 +358,49 @@ class Parser:
         return IfNode(condition=condition, consequent=consequent, alternative=alternative)
 
     def parseExpression(self):
-        left = self.parsePrimary()
+        left = self.parseComparison()
         while True:
             op = self.peek()
-            if op.type not in (TokenType.GT, TokenType.LT, TokenType.EQ_EQ,
-                           TokenType.NOT_EQ, TokenType.GT_EQ, TokenType.LT_EQ, TokenType.AND, TokenType.OR, TokenType.PIPE):
+            if op.type not in (TokenType.AND, TokenType.OR, TokenType.PIPE, TokenType.SEMICOLON):
                 break
             self.advance()
-            right = self.parsePrimary()
+            self._consumeSeparators()
+            right = self.parseComparison()
             left = BinaryOpNode(op.value, left, right)
         return left
-    
+
+    def parseComparison(self):
+        # word OP word binds tighter than && and ||; both sides stay words
+        # and are compared by the executor without running anything. For <
+        # and > the left word must be a variable, a quoted string, a number
+        # or @((...)); `(pwd > out)` still runs pwd into out.
+        tok, op = self.peek(), self.peekN(1).type
+        if op in REDIRECTING and not self.isValue(tok):
+            return self.parsePrimary()
+        if self.isOperand(tok) and op in COMPARISONS:
+            left = self.operand()
+            op = self.advance()
+            if not self.isOperand(self.peek()):
+                tok = self.peek()
+                raise SyntaxError(f"Expected a word after '{op.value}', line={tok.line} col={tok.col}")
+            right = self.operand()
+            return BinaryOpNode(op.value, left, right)
+        return self.parsePrimary()
+
+    def isOperand(self, tok):
+        return tok.type == TokenType.VAR or self.isCommandStart(tok)
+
+    def isValue(self, tok):
+        if tok.type == TokenType.WORD:
+            return NUMBER.fullmatch(tok.value) is not None
+        return tok.type in (TokenType.VAR, TokenType.STRING, TokenType.DSTRING, TokenType.ARITH)
+
+    def operand(self):
+        tok = self.advance()
+        if tok.type == TokenType.VAR:
+            return {"type": "VAR", "name": tok.value}
+        return self.word(tok)
+
     def parsePrimary(self):
         tok = self.peek()
         if tok.type == TokenType.LPAREN:
@@ -264,8 +410,8 @@ class Parser:
                 raise SyntaxError(f"Expected ')' after sub expression at {self.pos}")
             self.advance()
             return expr
-        elif tok.type in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING, TokenType.VAR):
-            return self.parseSequence()
+        elif self.isOperand(tok):
+            return self.parsePipeLine()
         else:
             raise SyntaxError(f"Unexpected token {tok}")
     
@@ -290,7 +436,60 @@ class Parser:
         return BlockNode(statements)
 
     def parseFor(self):
-        pass
+        # for name in word ... -> { ... }, the header may also be in parens
+        tok = self.peek()
+        paren = tok.type == TokenType.LPAREN
+        if paren:
+            self.advance()
+
+        tok = self.peek()
+        if tok.type != TokenType.WORD or tok.value in self.RESERVED:
+            raise SyntaxError(f"Expected a variable name after for, line={tok.line} col={tok.col}")
+        var = self.advance().value
+
+        tok = self.peek()
+        if tok.type != TokenType.WORD or tok.value != "in":
+            raise SyntaxError(f"Expected 'in' after for {var}, line={tok.line} col={tok.col}")
+        self.advance()
+
+        items = []
+        while True:
+            tok = self.peek()
+            if tok.type == TokenType.VAR:
+                self.advance()
+                items.append({"type": "VAR", "name": tok.value})
+            elif self.isCommandStart(tok):
+                items.append(self.word(self.advance()))
+            else:
+                break
+
+        if paren:
+            tok = self.peek()
+            if tok.type != TokenType.RPAREN:
+                raise SyntaxError(f"Expected ')' after for list, line={tok.line} col={tok.col}")
+            self.advance()
+
+        tok = self.peek()
+        if tok.type != TokenType.ARROW:
+            raise SyntaxError(f"Expected '->' after for list, line={tok.line} col={tok.col}")
+        self.advance()
+
+        body = self.parseBlock()
+        self._consumeSeparators()
+
+        return ForNode(var=var, items=items, body=body)
+
+    def word(self, tok):
+        # A word as stored in a command's argument list.
+        if tok.type == TokenType.STRING:
+            return ("STRING", tok.value)
+        if tok.type == TokenType.DSTRING:
+            return ("DSTRING", tok.value)
+        if tok.type == TokenType.SUBST:
+            return self.substitution(tok)
+        if tok.type == TokenType.ARITH:
+            return ArithmeticNode(tok.value)
+        return tok.value
 
     def parseWhile(self):
         tok = self.peek()
@@ -315,5 +514,110 @@ class Parser:
 
         return WhileNode(condition=condition, body=body)
     
+    def parseFunction(self):
+        # fn name -> { ... } or fn name(param ...) -> { ... }
+        tok = self.peek()
+        if tok.type != TokenType.WORD or tok.value in self.RESERVED:
+            raise SyntaxError(f"Expected a function name after fn, line={tok.line} col={tok.col}")
+        name = self.advance().value
+
+        params = []
+        if self.peek().type == TokenType.LPAREN:
+            self.advance()
+            while self.peek().type == TokenType.WORD:
+                params.append(self.advance().value)
+            tok = self.peek()
+            if tok.type != TokenType.RPAREN:
+                raise SyntaxError(f"Expected ')' after parameters of {name}, line={tok.line} col={tok.col}")
+            self.advance()
+
+        tok = self.peek()
+        if tok.type != TokenType.ARROW:
+            raise SyntaxError(f"Expected '->' after fn {name}, line={tok.line} col={tok.col}")
+        self.advance()
+
+        body = self.parseBlock()
+        self._consumeSeparators()
+
+        return FunctionNode(name=name, params=params, body=body)
+
+    def parseLocal(self):
+        # local name [= value] ...
+        self.advance()
+        assignments = []
+        while self.peek().type == TokenType.WORD:
+            if self.isAssignmentLookAhead():
+                a = self.parseAssignment()
+            else:
+                a = AssignmentNode(self.advance().value, None)
+            a.local = True
+            assignments.append(a)
+        return AssignmentListNode(assignments)
+
     def parseCase(self):
-        pass
\ No newline at end of file
+        # case word -> { pattern | pattern -> { ... } ... }, the word may also
+        # be in parens
+        tok = self.peek()
+        paren = tok.type == TokenType.LPAREN
+        if paren:
+            self.advance()
+
+        tok = self.peek()
+        if tok.type == TokenType.VAR:
+            self.advance()
+            word = {"type": "VAR", "name": tok.value}
+        elif self.isCommandStart(tok):
+            word = self.word(self.advance())
+        else:
+            raise SyntaxError(f"Expected a word after case, line={tok.line} col={tok.col}")
+
+        if paren:
+            tok = self.peek()
+            if tok.type != TokenType.RPAREN:
+                raise SyntaxError(f"Expected ')' after case word, line={tok.line} col={tok.col}")
+            self.advance()
+
+        tok = self.peek()
+        if tok.type != TokenType.ARROW:
+            raise SyntaxError(f"Expected '->' after case word, line={tok.line} col={tok.col}")
+        self.advance()
+
+        if self.peek().type != TokenType.LBRACE:
+            raise SyntaxError("Expected { to start the case arms")
+        self.advance()
+        self._consumeSeparators()
+
+        patterns = []
+        bodies = []
+        while self.peek().type not in (TokenType.RBRACE, TokenType.EOF):
+            arm = [self.casePattern()]
+            while self.peek().type == TokenType.PIPE:
+                self.advance()
+                arm.append(self.casePattern())
+
+            tok = self.peek()
+            if tok.type != TokenType.ARROW:
+                raise SyntaxError(f"Expected '->' after case pattern, line={tok.line} col={tok.col}")
+            self.advance()
+
+            patterns.append(arm)
+            bodies.append(self.parseBlock())
+            self._consumeSeparators()
+
+        if self.peek().type != TokenType.RBRACE:
+            raise SyntaxError("Expected '}' to close the case arms")
+        self.advance()
+        self._consumeSeparators()
+
+        static = all(isinstance(p, str) or isinstance(p, tuple) and self.literal(p) is not None
+                     for arm in patterns for p in arm)
+        return CaseNode(word=word, patterns=patterns, bodies=bodies, static=static)
+
+    def casePattern(self):
+        tok = self.peek()
+        if tok.type == TokenType.VAR:
+            self.advance()
+            return {"type": "VAR", "name": tok.value}
+        if tok.type in (TokenType.WORD, TokenType.STRING, TokenType.DSTRING):
+            return self.word(self.advance())
+        raise SyntaxError(f"Expected a case pattern, line={tok.line} col={tok.col}")
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os, re, time, heapq, fnmatch
+
+class Matcher:
+    # Picks the first of a list of arms, each a list of (isGlob, text)
+    # patterns, that matches a word. Literal patterns go in a dict and all
+    # glob patterns into one alternation with a named group per arm, so a
+    # match costs one lookup and at most one regex run however many arms
+    # there are.
+    def __init__(self, arms):
+        self.literals = {}
+        parts = []
+        for i, patterns in enumerate(arms):
+            globs = []
+            for isGlob, text in patterns:
+                if isGlob:
+                    globs.append(fnmatch.translate(text))
+                else:
+                    self.literals.setdefault(text, i)
+            if globs:
+                parts.append(f"(?P<a{i}>{'|'.join(globs)})")
+        self.regex = re.compile("|".join(parts)) if parts else None
+
+    def match(self, word):
+        arm = self.literals.get(word)
+        if self.regex is not None:
+            m = self.regex.match(word)
+            if m is not None:
+                i = int(m.lastgroup[1:])
+                if arm is None or i < arm:
+                    arm = i
+        return arm
+
+# Pathname expansion. A pattern is split at "/" and compiled once into a
+# list of components: literal names, wildcard regexes, or RECURSIVE for a
+# "**" component, which matches any number of directories. Directory
+# listings are cached, sorted, keyed on the directory's device and inode and
+# trusted only while its mtime is unchanged. Matches are produced lazily and
+# in sorted order.
+
+LITERAL, WILDCARD, RECURSIVE = range(3)
+MAGIC = "*?["
+
+# A listing younger than this may still change within the same mtime tick,
+# so it is not cached.
+RACY_NS = 2 * 10**9
+MAXLISTINGS = 256
+MAXPATTERNS = 1024
+
+def hasMagic(text):
+    return any(c in text for c in MAGIC)
+
+def joinPath(path, name):
+    if not path:
+        return name
+    return path + name if path.endswith("/") else path + "/" + name
+
+def sortKey(path):
+    return path.split("/")
+
+class Globber:
+    def __init__(self):
+        self.patterns = {}
+        self.listings = {}
+
+    def glob(self, pattern):
+        return list(self.iglob(pattern))
+
+    def iglob(self, pattern):
+        root, comps, dirOnly = self.compile(pattern)
+        if not comps:
+            return iter(())
+        return self.walk(root, comps, 0, dirOnly)
+
+    def compile(self, pattern):
+        compiled = self.patterns.get(pattern)
+        if compiled is not None:
+            return compiled
+        root = "/" if pattern.startswith("/") else ""
+        dirOnly = pattern.endswith("/")
+        comps = []
+        for part in pattern.split("/"):
+            if not part:
+                continue
+            if part == "**":
+                if not comps or comps[-1][0] != RECURSIVE:
+                    comps.append((RECURSIVE, None))
+            elif hasMagic(part):
+                regex = fnmatch.translate(part)
+                if not part.startswith("."):
+                    # wildcards never match a leading dot
+                    regex = r"(?!\.)" + regex
+                comps.append((WILDCARD, re.compile(regex).match))
+            else:
+                comps.append((LITERAL, part))
+        if len(self.patterns) >= MAXPATTERNS:
+            self.patterns.clear()
+        compiled = self.patterns[pattern] = (root, comps, dirOnly)
+        return compiled
+
+    def listing(self, path):
+        # (names, dirs, links) of a directory: names sorted, dirs and links
+        # the sets of subdirectories and of symlinks among them.
+        d = path or "."
+        try:
+            st = os.stat(d)
+        except OSError:
+            return (), frozenset(), frozenset()
+        key = (st.st_dev, st.st_ino)
+        hit = self.listings.get(key)
+        if hit is not None and hit[0] == st.st_mtime_ns:
+            return hit[1]
+
+        names = []
+        dirs = set()
+        links = set()
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    names.append(entry.name)
+                    try:
+                        if entry.is_dir():
+                            dirs.add(entry.name)
+                            if entry.is_symlink():
+                                links.add(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            return (), frozenset(), frozenset()
+        names.sort()
+        result = (names, dirs, links)
+
+        if time.time_ns() - st.st_mtime_ns > RACY_NS:
+            if len(self.listings) >= MAXLISTINGS:
+                del self.listings[next(iter(self.listings))]
+            self.listings[key] = (st.st_mtime_ns, result)
+        return result
+
+    def walk(self, path, comps, i, dirOnly):
+        kind, value = comps[i]
+        last = i == len(comps) - 1
+
+        if kind == LITERAL:
+            p = joinPath(path, value)
+            if last:
+                if os.path.isdir(p) if dirOnly else os.path.lexists(p):
+                    yield p + "/" if dirOnly else p
+            elif os.path.isdir(p):
+                yield from self.walk(p, comps, i + 1, dirOnly)
+            return
+
+        if kind == WILDCARD:
+            names, dirs, links = self.listing(path)
+            for name in filter(value, names):
+                if last:
+                    if not dirOnly:
+                        yield joinPath(path, name)
+                    elif name in dirs:
+                        yield joinPath(path, name) + "/"
+                elif name in dirs:
+                    yield from self.walk(joinPath(path, name), comps, i + 1, dirOnly)
+            return
+
+        if last and path:
+            # "dir/**" matches dir/ itself as well
+            yield joinPath(path, "")
+        yield from self.recurse(path, comps, i, dirOnly)
+
+    def recurse(self, path, comps, i, dirOnly):
+        # "**": the rest of the pattern is tried here and in every directory
+        # below, merged back into sorted order. Hidden directories and
+        # symlinks to directories are not descended into.
+        last = i == len(comps) - 1
+        names, dirs, links = self.listing(path)
+
+        def below():
+            for name in names:
+                if name in dirs and name not in links and not name.startswith("."):
+                    yield from self.recurse(joinPath(path, name), comps, i, dirOnly)
+
+        if last:
+            here = (joinPath(path, name) + "/" if dirOnly else joinPath(path, name)
+                    for name in names
+                    if not name.startswith(".") and (not dirOnly or name in dirs))
+        else:
+            here = self.walk(path, comps, i + 1, dirOnly)
+        yield from heapq.merge(here, below(), key=sortKey)
@@ -0,0 +1,272 @@
+import os, sys, time, atexit, threading
+
+# Where a script spends its time. Nothing here runs unless profiling was
+# asked for: attach() wraps the executor's entry points in timers, detach()
+# puts them back, so an unprofiled shell pays nothing.
+#
+#   --profile                 print a report to stderr when the shell exits
+#   --profile-file PATH       also write collapsed stacks to PATH, one
+#                             "frame;frame;frame microseconds" line per
+#                             stack, as flamegraph.pl and speedscope read
+#
+# The same settings can come from RAYSHELL_PROFILE=1 and
+# RAYSHELL_PROFILE_FILE. The `profile` builtin starts and stops it at run
+# time.
+#
+# Every Executor.run() call is a frame keyed by the node's source line and
+# kind. Time in the lexer, parser, expander, in launching a command (fork or
+# posix_spawn) and in waiting on it is a phase frame nested under the node
+# that caused it. A frame's self time is its wall time minus its children's.
+
+PHASES = ("lex", "parse", "expand", "spawn", "wait")
+TOP = 40
+
+active = None
+
+def label(node):
+    kind = node.type.name
+    match kind:
+        case "COMMAND":
+            # unexpanded names may still be (kind, text) word tuples
+            detail = node.name[1] if isinstance(node.name, tuple) else node.name
+        case "FOR":
+            detail = node.var
+        case "FUNCTION" | "ASSIGNMENT":
+            detail = node.name
+        case "BINARYOP":
+            detail = node.op
+        case _:
+            detail = None
+    text = f"{kind} {detail}" if isinstance(detail, str) and detail else kind
+    return text.replace("\n", " ")
+
+class Stat:
+    __slots__ = ("calls", "total", "own", "phases", "depth")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        # nesting of this key on the stack; only the outermost call adds to total
+        self.depth = 0
+
+class Frame:
+    __slots__ = ("name", "stat", "line", "start", "children")
+
+    def __init__(self, name, stat, line):
+        self.name = name
+        self.stat = stat
+        self.line = line
+        self.start = time.perf_counter()
+        self.children = 0.0
+
+class Profile:
+    def __init__(self, collapsedPath=None):
+        self.collapsedPath = collapsedPath
+        self.thread = threading.get_ident()
+        self.stats = {}
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.stacks = {}
+        self.stack = []
+        self.started = time.perf_counter()
+        self.ex = None
+
+    # Frames
+
+    def enter(self, name, stat, line):
+        frame = Frame(name, stat, line)
+        if stat is not None:
+            stat.depth += 1
+        self.stack.append(frame)
+        return frame
+
+    def leave(self, frame):
+        elapsed = time.perf_counter() - frame.start
+        own = elapsed - frame.children
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].children += elapsed
+        path = tuple(f.name for f in self.stack) + (frame.name,)
+        self.stacks[path] = self.stacks.get(path, 0.0) + own
+        stat = frame.stat
+        if stat is None:
+            # a phase: charge it to the node that caused it
+            phase = frame.name[1:-1]
+            self.phases[phase] += own
+            owner = self.owner()
+            if owner is not None:
+                owner.phases[phase] += own
+            return
+        stat.calls += 1
+        stat.own += own
+        stat.depth -= 1
+        if not stat.depth:
+            stat.total += elapsed
+
+    def owner(self):
+        for frame in reversed(self.stack):
+            if frame.stat is not None:
+                return frame.stat
+        return None
+
+    def currentLine(self):
+        for frame in reversed(self.stack):
+            if frame.line is not None:
+                return frame.line
+        return None
+
+    def node(self, run, node):
+        if threading.get_ident() != self.thread:
+            return run(node)
+        line = getattr(node, "line", None) or self.currentLine()
+        text = label(node)
+        key = (line, text)
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = Stat()
+        # ";" separates frames in the collapsed output
+        name = text.replace(";", "SEQ")
+        frame = self.enter(f"{name}:{line}" if line else name, stat, line)
+        try:
+            return run(node)
+        finally:
+            self.leave(frame)
+
+    def phase(self, name, fn, *args, **kwargs):
+        if threading.get_ident() != self.thread:
+            return fn(*args, **kwargs)
+        frame = self.enter(f"[{name}]", None, None)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.leave(frame)
+
+    def iterPhase(self, name, items):
+        # Times each step of an iterator, for streamed tokens, statements
+        # and for-loop words.
+        items = iter(items)
+        while True:
+            frame = self.enter(f"[{name}]", None, None)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.leave(frame)
+            yield item
+
+    # Hooks
+
+    def attach(self, ex):
+        self.ex = ex
+        run = ex.run
+        ex.run = lambda node: self.node(run, node)
+        for target, name, phase in ((ex, "launch", "spawn"),
+                                    (ex.reaper, "wait", "wait"),
+                                    (ex.reaper, "waitJob", "wait"),
+                                    (ex.expander, "expand", "expand"),
+                                    (ex.expander, "expandScalar", "expand"),
+                                    (ex.expander, "expandOperand", "expand"),
+                                    (ex.expander, "casePattern", "expand")):
+            self.wrap(target, name, phase)
+        iterWords = ex.expander.iterWords
+        ex.expander.iterWords = lambda words: self.iterPhase("expand", iterWords(words))
+
+    def wrap(self, target, name, phase):
+        fn = getattr(target, name)
+        setattr(target, name, lambda *args, **kwargs: self.phase(phase, fn, *args, **kwargs))
+
+    def detach(self):
+        ex = self.ex
+        if ex is None:
+            return
+        for target, names in ((ex, ("run", "launch")),
+                              (ex.reaper, ("wait", "waitJob")),
+                              (ex.expander, ("expand", "expandScalar", "expandOperand", "casePattern", "iterWords"))):
+            for name in names:
+                target.__dict__.pop(name, None)
+        self.ex = None
+
+    def tapTokens(self, tokens):
+        return self.iterPhase("lex", tokens)
+
+    def tapStatements(self, statements):
+        return self.iterPhase("parse", statements)
+
+    # Output
+
+    def report(self, top=TOP):
+        wall = time.perf_counter() - self.started
+        ms = lambda s: f"{s * 1000:10.2f}"
+        lines = [f"profile: {wall * 1000:.1f} ms wall, "
+                 + ", ".join(f"{p} {self.phases[p] * 1000:.1f} ms" for p in PHASES)]
+        lines.append(f"{'calls':>8} {'total ms':>10} {'self ms':>10} {'spawn ms':>10} {'wait ms':>10} {'expand ms':>10}  line  node")
+        ranked = sorted(((k, s) for k, s in self.stats.items() if s.calls), key=lambda kv: kv[1].own + sum(kv[1].phases.values()), reverse=True)
+        for (line, text), stat in ranked[:top]:
+            lines.append(f"{stat.calls:8} {ms(stat.total)} {ms(stat.own)} {ms(stat.phases['spawn'])}"
+                         f" {ms(stat.phases['wait'])} {ms(stat.phases['expand'])}  {line or '-':>4}  {text}")
+        if len(ranked) > top:
+            lines.append(f"... {len(ranked) - top} more")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        return "".join(f"{';'.join(path)} {round(own * 1e6)}\n"
+                       for path, own in sorted(self.stacks.items()) if round(own * 1e6) > 0)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+    def finish(self):
+        self.detach()
+        sys.stderr.write(self.report() + "\n")
+        if self.collapsedPath:
+            try:
+                self.dump(self.collapsedPath)
+            except OSError as e:
+                sys.stderr.write(f"profile: {e}\n")
+
+def start(ex, collapsedPath=None):
+    global active
+    stop()
+    active = Profile(collapsedPath)
+    active.attach(ex)
+    return active
+
+def stop():
+    global active
+    prof, active = active, None
+    if prof is not None:
+        prof.detach()
+    return prof
+
+def finish():
+    prof = stop()
+    if prof is not None:
+        prof.finish()
+
+def configure(argv, ex, environ=os.environ):
+    # Strips the profiling flags from argv and, if they asked for it,
+    # profiles ex until the shell exits.
+    enabled = bool(environ.get("RAYSHELL_PROFILE"))
+    path = environ.get("RAYSHELL_PROFILE_FILE") or None
+
+    rest = []
+    it = iter(argv)
+    for arg in it:
+        if arg == "-c":
+            rest.append(arg)
+            rest.extend(it)
+            break
+        if arg == "--profile":
+            enabled = True
+        elif arg == "--profile-file":
+            path = next(it, None)
+        else:
+            rest.append(arg)
+
+    if enabled or path:
+        start(ex, path)
+        atexit.register(finish)
+    return rest
@@ -0,0 +1,124 @@
+import os, signal, select, time
+
+class Reaper:
+    # Owns every waitpid() in the shell. The SIGCHLD handler does nothing but
+    # exist: with signal.set_wakeup_fd the C-level handler writes a byte to a
+    # self-pipe, and whoever is waiting polls that pipe, reaps with WNOHANG and
+    # hands each status to the JobTable. A child that exits between a reap
+    # and the poll still leaves its byte in the pipe, so no wakeup is lost.
+    def __init__(self, jobTable):
+        self.jobTable = jobTable
+        self.open()
+        signal.signal(signal.SIGCHLD, self.sigchldHandler)
+        os.register_at_fork(after_in_child=self.open)
+
+    def open(self):
+        # Also runs in a forked child, which must not share the parent's pipe.
+        old = getattr(self, "fds", None)
+        self.fds = os.pipe()
+        for fd in self.fds:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.fds[1], warn_on_full_buffer=False)
+        self.poller = select.poll()
+        self.poller.register(self.fds[0], select.POLLIN)
+        if old:
+            for fd in old:
+                os.close(fd)
+
+    def sigchldHandler(self, signum, frame):
+        pass
+
+    def drain(self):
+        try:
+            while os.read(self.fds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def reapAll(self):
+        # Returns False once the shell has no children left at all.
+        self.drain()
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+            except ChildProcessError:
+                return False
+            if pid == 0:
+                return True
+            self.jobTable.reap(pid, status)
+
+    def reapPid(self, pid):
+        try:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            # collected behind our back; don't leave the job waiting forever
+            wpid, status = pid, 0
+        if wpid:
+            self.jobTable.reap(wpid, status)
+
+    def wait(self, jobs, first=False, timeout=None, stops=False):
+        # Wait until every job in jobs (or with first, any one of them) has
+        # exited; with stops a stopped job counts as finished too. Each live
+        # pid gets a pidfd, so the poll wakes exactly when one of *our* pids
+        # exits rather than on every SIGCHLD. Without pidfd support, or when
+        # stops matter, the SIGCHLD self-pipe is polled as well. Returns the
+        # finished jobs in the order they finished; fewer than asked for if
+        # timeout (seconds) ran out.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poller = select.poll()
+        pidfds = {}
+        try:
+            watchSignals = stops
+            for job in jobs:
+                for pid in job.pids:
+                    if pid in job.codes:
+                        continue
+                    try:
+                        fd = os.pidfd_open(pid)
+                    except ProcessLookupError:
+                        self.reapPid(pid)
+                        continue
+                    except (AttributeError, OSError):
+                        watchSignals = True
+                        continue
+                    pidfds[fd] = pid
+                    poller.register(fd, select.POLLIN)
+            if watchSignals:
+                poller.register(self.fds[0], select.POLLIN)
+                self.reapAll()
+
+            while True:
+                done = [j for j in jobs if j.live == 0 or (stops and j.status == 'stopped')]
+                if len(done) == len(jobs) or (first and done):
+                    return self.byCompletion(done)
+                ms = None
+                if deadline is not None:
+                    ms = max(0, int((deadline - time.monotonic()) * 1000))
+                events = poller.poll(ms)
+                if not events and deadline is not None and time.monotonic() >= deadline:
+                    return self.byCompletion(done)
+                for fd, _ in events:
+                    if fd == self.fds[0]:
+                        if not self.reapAll():
+                            for job in jobs:
+                                if job.live:
+                                    self.jobTable.remove(job.pgid)
+                                    job.live = 0
+                                    job.status = 'done'
+                        continue
+                    pid = pidfds.pop(fd)
+                    poller.unregister(fd)
+                    os.close(fd)
+                    self.reapPid(pid)
+        finally:
+            for fd in pidfds:
+                os.close(fd)
+
+    def byCompletion(self, jobs):
+        # jobs given up on when the shell ran out of children sort last
+        return sorted(jobs, key=lambda j: j.settled if j.settled is not None else float("inf"))
+
+    def waitJob(self, job, timeout=None):
+        # Foreground wait: returns once the job has exited or stopped.
+        self.wait([job], timeout=timeout, stops=True)
+        return job
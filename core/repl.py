@@ -1,36 +1,30 @@
 from core.lexer import Lexer
 from core.parser import Parser
 from core.executor import Executor
-from core.ast import saveASTtoJson
-import os, readline, signal, sys
-from core.expander import Expander
+import sys, time, atexit
+from core import trace, astcache, profiler
 
-HISTORYFILE = os.path.expanduser("~/.rayshell_history")
-
-LEXER:bool = False
-PARSER:bool = True
 EXECUTOR:bool = True
 ex = Executor()
 
 def runScript(file_path: str):
-    # print(f"\n---EXECUTING SCRIPT: {file_path}---")
+    # Statements are lexed, parsed, expanded and run one at a time as the
+    # file is read, so a script starts at once and runs in constant memory.
     try:
         with open(file_path, 'r') as f:
-            # for line in f:
-            line = f.read()
-                
-            lexer = Lexer(line=line)
-                
-            tokens = lexer.nextToken()
-            if LEXER:
-                lexerDebug(tokens)
-            parser = Parser(tokens)
-            ast = parser.parse()
-            if PARSER:
-                parserDebug(ast)
-            if ast:
-                exp = Expander(ex)
-                ast = exp.expand(ast)
+            statements = astcache.load(file_path, f)
+            if statements is None:
+                tokens = Lexer(reader=f).iterTokens()
+                if trace.active:
+                    tokens = trace.active.tapTokens(tokens)
+                if profiler.active:
+                    tokens = profiler.active.tapTokens(tokens)
+                statements = astcache.record(file_path, f, Parser(tokens).statements())
+            if profiler.active:
+                statements = profiler.active.tapStatements(statements)
+            for ast in statements:
+                if trace.active:
+                    trace.active.dumpAST(ast)
                 executor(ex, ast)
     except FileNotFoundError:
         raise FileNotFoundError(f"Error: Script file not found at {file_path}")
@@ -39,63 +33,79 @@ def runScript(file_path: str):
 
 def repl(cmd: str = None):
 
-    loadHistory()
-
-    if len(sys.argv) > 1 and sys.argv[1] == "-c":
-        runOnce(" ".join(sys.argv[2:]))
-    else:
-        while True:
-            try:
-                line = input("rayshell> ")
-                saveHistory()
-
-            except EOFError:
-                saveHistory()
-                break
-            except KeyboardInterrupt:
-                print()
-                continue
-
-            if line.strip() in ("bye","exit"):
-                print("bye-bye")
-                break
-
-            if line.startswith("./") :
-                try:
-                    runScript(line)
-                except FileNotFoundError as e:
-                    print(e)
-                continue
-
-            lexer= Lexer(line=line)
-            tokens = lexer.nextToken()
-            if LEXER:
-                lexerDebug(tokens)
-
-            parser = Parser(tokens)
-            try:
-                ast = parser.parse()
-                if ast is None:
-                    continue
-            except SyntaxError as e:
-                print(f"SyntaxError {e}")
-                continue
-
-            for job in ex.jobTable.list():
-                print(job.pgid, job.status, job.cmd)
-        
-            exp = Expander(ex)
-            ast = exp.expand(ast)
-            if PARSER:
-                parserDebug(ast)
-                
-            if EXECUTOR:
-                try:
-                    executor(ex, ast)
-                except SyntaxError as e:
-                    print(f"SyntaxError {e}")
-                    continue
-    saveHistory()
+    args = trace.configure(sys.argv[1:])
+    args = profiler.configure(args, ex)
+
+    if args and args[0] == "-c":
+        runOnce(" ".join(args[1:]))
+        return
+
+    # Only an interactive shell pays for readline, history and the terminal.
+    ex.setupInteractive()
+    history = loadHistory()
+    while True:
+        try:
+            line = input("rayshell> ")
+        except EOFError:
+            break
+        except KeyboardInterrupt:
+            print()
+            continue
+
+        if line.strip() in ("bye","exit"):
+            print("bye-bye")
+            break
+
+        started = time.time()
+        status = runLine(line)
+        history.add(line, status, started)
+
+def runLine(line):
+    if line.startswith("./") :
+        try:
+            runScript(line)
+        except FileNotFoundError as e:
+            print(e)
+        return ex.lastStatus
+
+    tokens = lex(line)
+    if trace.active:
+        trace.active.dumpTokens(tokens)
+
+    try:
+        ast = parse(tokens)
+        if ast is None:
+            return ex.lastStatus
+        if trace.active:
+            trace.active.dumpAST(ast)
+    except SyntaxError as e:
+        print(f"SyntaxError {e}")
+        return 2
+
+    ex.reaper.reapAll()
+    for job in ex.jobTable.list():
+        print(job.pgid, job.status, job.cmd)
+    for job in ex.jobTable.finished():
+        ex.jobTable.collect(job)
+
+
+    if EXECUTOR:
+        try:
+            executor(ex, ast)
+        except SyntaxError as e:
+            print(f"SyntaxError {e}")
+            return 2
+    return ex.lastStatus
+
+def lex(line):
+    if profiler.active:
+        return profiler.active.phase("lex", Lexer(line=line).nextToken)
+    return Lexer(line=line).nextToken()
+
+def parse(tokens):
+    if profiler.active:
+        return profiler.active.phase("parse", Parser(tokens).parse)
+    return Parser(tokens).parse()
 
 def executor(ex, ast):
         # print("\n---EXECUTION---")
@@ -105,36 +115,27 @@ def runOnce(cmd: str = None):
     if not cmd.strip():
         return None
     
-    lexer = Lexer(line=cmd)
-    tokens = lexer.nextToken()
-    parser = Parser(tokens)
-    ast = parser.parse()
+    tokens = lex(cmd)
+    if trace.active:
+        trace.active.dumpTokens(tokens)
+    ast = parse(tokens)
     if ast is None:
         return None
-    exp = Expander(ex)
-    ast = exp.expand(ast)
+    if trace.active:
+        trace.active.dumpAST(ast)
     return executor(ex, ast)
 
-def lexerDebug(tokens):
-    print("---LEXER---")
-    for token in tokens:
-        print(token)
-
-def parserDebug(ast):
-    try:
-        saveASTtoJson(ast, os.path.join("", "/home/venkat/rayshell/core/ast.json"))
-    except Exception as e:
-        pass
-
 def loadHistory():
-    if os.path.exists(HISTORYFILE):
-        readline.read_history_file(HISTORYFILE)
-
-def saveHistory():
-    try:
-        readline.write_history_file(HISTORYFILE)
-    except Exception as e:
-        print(f"error writing history {e}")
+    # Only the tail of the file is read; new commands are appended to it in
+    # the background as they are entered.
+    import readline
+    from core.history import History
+    history = History()
+    for command in history.load():
+        readline.add_history(command)
+    ex.history = history
+    atexit.register(history.close)
+    return history
 
 if __name__ == "__main__":
     repl()
@@ -1,23 +1,46 @@
-import os, signal, readline,subprocess
-from datetime import datetime, timedelta
+import os, signal, time, threading
+from core.jobs import Job
+from core.ast import CommandNode
+from core import profiler
 
 BUILTINS = {
-    "cd", "pwd", "echo", "jump", "cwd", "disp", "print", "hi","jobs", "fg","bg","history"  
+    "cd", "pwd", "echo", "jump", "cwd", "disp", "print", "hi","jobs", "fg","bg","history","hash","shopt","wait","parallel","return","profile"
 }
 
+# Builtins that change the shell itself. Inside a pipeline they still run in
+# a forked child, unless lastpipe lets the last stage run in the shell.
+STATEFUL_BUILTINS = {"cd", "jump", "fg", "bg", "hash", "shopt", "wait", "return", "profile"}
+
+# Builtins that read stdin; inside a pipeline they always fork.
+STDIN_BUILTINS = {"parallel"}
+
 BTRFS_PARTITION = "/dev/vda1"
 HOME_SUBVOL = "/home"
 SNAPSHOT_MOUNT = "/mnt/tenet"
 
+class FunctionReturn(Exception):
+    # Raised by `return` and caught by Executor.callFunction.
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
 class BuiltinFns:
-    def __init__(self, cmd, args, ex):
+    def __init__(self, cmd, args, ex, stdout=1):
         self.cmd = cmd
         self.args = args
         self.ex = ex
+        self.stdout = stdout
         self.narrativeEngine = None
 
     def __repr__(self):
         return f"{self.cmd}, {self.args}"
+    def out(self, *parts, sep=" ", end="\n"):
+        # Builtins may run on a pipeline thread, so they write to their own
+        # fd rather than through sys.stdout.
+        data = (sep.join(str(p) for p in parts) + end).encode()
+        while data:
+            data = data[os.write(self.stdout, data):]
+
     def main(self):
         if self.cmd in ("cd", "jump"):
             return self.handle_cd()
@@ -35,85 +58,453 @@ class BuiltinFns:
             return self.handle_bg()
         if self.cmd == "history":
             return self.handle_history()
+        if self.cmd == "hash":
+            return self.handle_hash()
+        if self.cmd == "shopt":
+            return self.handle_shopt()
+        if self.cmd == "wait":
+            return self.handle_wait()
+        if self.cmd == "parallel":
+            return self.handle_parallel()
+        if self.cmd == "return":
+            return self.handle_return()
+        if self.cmd == "profile":
+            return self.handle_profile()
         return 0
         
     def handle_cd(self):
         # if self.cmd == "cd":
             # print("this isn't bash mate, type 'jump' from here on")
-        target = self.args[0] if self.args else os.getenv("HOME")
+        target = self.args[0] if self.args else self.ex.vars.get("HOME", None)
         try:
             os.chdir(target)
             self.cwd = os.getcwd()
-            print(self.cwd)
+            self.out(self.cwd)
             return 0
         except Exception as e:
-            print(f"cd: {e}")
+            self.out(f"cd: {e}")
             return 1
         
     def handle_history(self):
-        historyLen = readline.get_current_history_length()
-        if historyLen > 0:
-            for i in range(1, historyLen + 1):
-                print(f"{i:4} {readline.get_history_item(i)}")
+        # history [-m] [N]: the newest N commands, -m adds when they ran,
+        # their status and how long they took where that was recorded.
+        history = self.ex.history
+        args = list(self.args)
+        showMeta = bool(args) and args[0] == "-m"
+        if showMeta:
+            args.pop(0)
+        count = None
+        if args:
+            try:
+                count = int(args[0])
+            except ValueError:
+                self.out(f"history: {args[0]}: numeric argument required")
+                return 1
+        if history is None:
             return 0
-        
+        lines = []
+        for number, command, meta in history.last(count):
+            if showMeta and meta is not None:
+                start, status, ms = meta
+                when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))
+                lines.append(f"{number:5}  {when} {status:3} {ms:6}ms  {command}")
+            else:
+                lines.append(f"{number:5}  {command}")
+        if lines:
+            self.out("\n".join(lines))
+        return 0
+
+    def handle_hash(self):
+        table = self.ex.cmdHash
+        args = list(self.args)
+        if not args:
+            if not table:
+                self.out("hash: hash table empty")
+                return 0
+            self.out("hits\tcommand")
+            for name, (path, hits) in table.items():
+                self.out(f"{hits:4}\t{path}")
+            return 0
+
+        if args[0] == "-r":
+            table.clear()
+            return 0
+
+        if args[0] == "-d":
+            status = 0
+            for name in args[1:]:
+                if table.pop(name, None) is None:
+                    self.out(f"hash: {name}: not found")
+                    status = 1
+            return status
+
+        if args[0] == "-p":
+            if len(args) < 3:
+                self.out("hash: usage: hash -p path name")
+                return 1
+            table[args[2]] = [args[1], 0]
+            return 0
+
+        status = 0
+        for name in args:
+            if "/" in name:
+                continue
+            table.pop(name, None)
+            path = self.ex.resolveCommand(name)
+            if path is None:
+                self.out(f"hash: {name}: not found")
+                status = 1
+            else:
+                table[name][1] = 0
+        return status
+
+    def handle_shopt(self):
+        opts = self.ex.options
+        if not self.args:
+            for name, value in opts.items():
+                self.out(f"{name}\t{'on' if value else 'off'}")
+            return 0
+        if self.args[0] not in ("-s", "-u"):
+            self.out("shopt: usage: shopt [-s|-u] [optname ...]")
+            return 1
+        status = 0
+        for name in self.args[1:]:
+            if name not in opts:
+                self.out(f"shopt: {name}: invalid shell option name")
+                status = 1
+                continue
+            opts[name] = self.args[0] == "-s"
+        return status
+
     def handle_hi(self):
-        print("hey, I don't talk much. I just execute commands.")
+        self.out("hey, I don't talk much. I just execute commands.")
         return 0
 
     def handle_pwd(self):
-        print(os.getcwd())
+        self.out(os.getcwd())
         return 0
 
-    def handle_echo(self, stdout = 1):
-        os.write(stdout, (" ".join(self.args) + "\n").encode())
+    def handle_echo(self):
+        self.out(" ".join(self.args))
         # print(" ".join(self.args))
         return 0
         
     def handle_jobs(self):
+        self.ex.reaper.reapAll()
         jt = self.ex.jobTable
-        for idx, job in enumerate(jt.list(), start=1):
-            print(f"[{idx}] {job.status}\t{job.cmd}")
+        for job in jt.list():
+            self.out(f"[{job.id}] {job.status}\t{job.cmd}")
+        for job in jt.finished():
+            jt.collect(job)
         return 0
 
     def handle_fg(self):
         jt = self.ex.jobTable
         if not jt.list():
-            print("fg: no current job")
+            self.out("fg: no current job")
             return 1
-        idx = int(self.args[0][1:]) if self.args else len(jt.list())
+        idx = int(self.args[0][1:]) if self.args else jt.current().id
         job = jt.get_by_index(idx) 
         if not job:
-            print(f"fg: {idx}: no such job")
+            self.out(f"fg: {idx}: no such job")
             return 1
 
-        os.tcsetpgrp(self.ex.tty_fd, job.pgid)
+        if job.status == 'done':
+            jt.collect(job)
+            return job.codes.get(job.pids[-1], 0)
+
+        # in the foreground the job is collected as soon as it exits
+        job.background = False
+        for pid in job.codes:
+            jt.byPid.pop(pid, None)
+        tty = self.ex.tty_fd
+        if os.isatty(tty):
+            os.tcsetpgrp(tty, job.pgid)
         os.killpg(job.pgid, signal.SIGCONT)
+        job.status = 'running'
         self.ex.fg_pgid = job.pgid
+        self.ex.reaper.waitJob(job)
+        self.ex.fg_pgid = 0
+        if os.isatty(tty):
+            os.tcsetpgrp(tty, os.getpgrp())
+        return job.codes.get(job.pids[-1], 0)
+    
+    def handle_wait(self):
+        # wait [-n] [-t seconds] [%job | pid ...]
+        jt = self.ex.jobTable
+        first = False
+        timeout = None
+        args = list(self.args)
+        while args and args[0].startswith("-"):
+            opt = args.pop(0)
+            if opt == "-n":
+                first = True
+            elif opt == "-t" and args:
+                try:
+                    timeout = float(args.pop(0))
+                except ValueError:
+                    self.out("wait: -t: number expected")
+                    return 2
+            else:
+                self.out("wait: usage: wait [-n] [-t seconds] [%job | pid ...]")
+                return 2
 
-        for pid in job.pids:
-            _, status = os.waitpid(pid, os.WUNTRACED)
-            if os.WIFSTOPPED(status):
-                job.status = 'stopped'
-            elif os.WIFEXITED(status) or os.WIFSIGNALED(status):
-                self.ex.jobTable.remove(job.pgid)
+        # (job, pid) for each operand; pid is None for a %job
+        targets = []
+        for spec in args:
+            pid = None
+            if spec.startswith("%") and spec[1:].isdigit():
+                job = jt.get_by_index(int(spec[1:]))
+            elif spec.isdigit():
+                pid = int(spec)
+                job = jt.getByPid(pid)
+                if job is None and pid in jt.statuses:
+                    # collected by a notification already; just its code
+                    targets.append((None, pid))
+                    continue
+            else:
+                job = None
+            if job is None:
+                self.out(f"wait: {spec}: no such job")
+                return 127
+            targets.append((job, pid))
+        if args:
+            jobs = [job for job, _ in targets if job is not None]
+        else:
+            self.ex.reaper.reapAll()
+            jobs = jt.list()
+            if not jobs:
+                return 127 if first else 0
 
-        self.ex.fg_pgid = 0
-        os.tcsetpgrp(self.ex.tty_fd, os.getpgrp())
+        if first:
+            for job, pid in targets:
+                if job is None:
+                    return jt.statuses.pop(pid, 0)
+            done = self.ex.reaper.wait(jobs, first=True, timeout=timeout)
+            if not done:
+                return 124
+            # the job that finished first, and the pid it was named by
+            job = done[0]
+            jt.collect(job)
+            pid = next((pid for j, pid in targets if j is job and pid is not None), job.pids[-1])
+            return job.codes.get(pid, 0)
+
+        done = self.ex.reaper.wait(jobs, timeout=timeout)
+        for job in done:
+            jt.collect(job)
+        if len(done) < len(jobs):
+            return 124
+        if not args:
+            return 0
+        job, pid = targets[-1]
+        if job is None:
+            return jt.statuses.pop(pid, 0)
+        return job.codes.get(pid if pid is not None else job.pids[-1], 0)
+
+    def handle_return(self):
+        if not self.ex.callDepth:
+            self.out("return: can only return from a function")
+            return 1
+        status = self.ex.lastStatus
+        if self.args:
+            try:
+                status = int(self.args[0]) & 255
+            except ValueError:
+                self.out(f"return: {self.args[0]}: numeric argument required")
+                status = 2
+        raise FunctionReturn(status)
+
+    def handle_profile(self):
+        # profile on [file] | off | report | dump file
+        args = list(self.args)
+        action = args.pop(0) if args else None
+        prof = profiler.active
+        match action:
+            case None:
+                self.out(f"profile: {'on' if prof else 'off'}")
+            case "on":
+                profiler.start(self.ex, args[0] if args else None)
+            case "off":
+                prof = profiler.stop()
+                if prof is None:
+                    self.out("profile: not running")
+                    return 1
+                self.out(prof.report())
+                if prof.collapsedPath:
+                    try:
+                        prof.dump(prof.collapsedPath)
+                    except OSError as e:
+                        self.out(f"profile: {e}")
+                        return 1
+            case "report" | "dump" if prof is None:
+                self.out("profile: not running")
+                return 1
+            case "report":
+                self.out(prof.report())
+            case "dump" if args:
+                try:
+                    prof.dump(args[0])
+                except OSError as e:
+                    self.out(f"profile: {e}")
+                    return 1
+            case _:
+                self.out("profile: usage: profile [on [file] | off | report | dump file]")
+                return 2
         return 0
-    
+
+    def handle_parallel(self):
+        # parallel [-j N] cmd [args ...] [::: arg ...]
+        # Runs cmd once per argument, with "{}" replaced by it or the argument
+        # appended, keeping at most N tasks running. Without ::: arguments are
+        # read from stdin, one per line. A task's stdout and stderr are
+        # buffered and written out together when it exits, so output from
+        # different tasks never interleaves. Tasks read /dev/null, as in GNU
+        # parallel: they run in process groups of their own and would be
+        # stopped for reading the terminal. A task stopped anyway counts as
+        # failed and stays behind as a stopped job. Returns the number of
+        # failed tasks, capped at 101, or 130 if interrupted: SIGINT is
+        # passed on to the running tasks and no new ones are started.
+        args = list(self.args)
+        limit = os.cpu_count() or 1
+        if args and args[0].startswith("-j"):
+            opt = args.pop(0)
+            value = opt[2:] or (args.pop(0) if args else "")
+            if not value.isdigit() or int(value) < 1:
+                self.out("parallel: -j: positive number expected")
+                return 2
+            limit = int(value)
+        stdin = None
+        if ":::" in args:
+            i = args.index(":::")
+            template, inputs = args[:i], iter(args[i + 1:])
+        else:
+            template, inputs = args, self.readLines(0)
+        if not template:
+            self.out("parallel: usage: parallel [-j N] cmd [args ...] [::: arg ...]")
+            return 2
+
+        ex = self.ex
+        cmd = template[0]
+        exe = None
+        if cmd not in BUILTINS:
+            exe = ex.resolveCommand(cmd)
+            if exe is None:
+                self.out(f"parallel: {cmd}: command not found")
+                return 127
+            stdin = os.open(os.devnull, os.O_RDONLY)
+        env = ex.vars.environ()
+
+        running = {}
+        failed = 0
+        interrupted = False
+
+        def interrupt(signum, frame):
+            nonlocal interrupted
+            interrupted = True
+            for job in running:
+                try:
+                    os.killpg(job.pgid, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+
+        oldHandler = None
+        if threading.current_thread() is threading.main_thread():
+            oldHandler = signal.signal(signal.SIGINT, interrupt)
+        try:
+            while True:
+                while len(running) < limit and not interrupted:
+                    arg = next(inputs, None)
+                    if arg is None:
+                        break
+                    argv = [w.replace("{}", arg) for w in template]
+                    if "{}" not in "".join(template[1:]):
+                        argv.append(arg)
+                    out, err = self.taskBuffer(), self.taskBuffer()
+                    if exe is None:
+                        status = BuiltinFns(cmd, argv[1:], ex, stdout=out).main() or 0
+                        failed += status != 0
+                        self.flushTask(out, err)
+                        continue
+                    try:
+                        pid = ex.launch(CommandNode(name=("WORD", cmd), args=argv[1:]),
+                                        exe, argv, env, stdin=stdin, stdout=out, stderr=err)
+                    except OSError as e:
+                        os.write(err, f"{cmd}: {e.strerror}\n".encode())
+                        failed += 1
+                        self.flushTask(out, err)
+                        continue
+                    job = Job(pgid=pid, pids=[pid], cmd=" ".join(argv), status='running')
+                    ex.jobTable.add(job)
+                    running[job] = (out, err)
+                    if interrupted:
+                        # the interrupt came in while this one was launching
+                        os.killpg(pid, signal.SIGINT)
+                if not running:
+                    break
+                for job in ex.reaper.wait(list(running), first=True, stops=True):
+                    out, err = running.pop(job)
+                    if job.status == 'stopped':
+                        self.out(f"[{job.pgid}] Stopped {job.cmd}")
+                        failed += 1
+                    else:
+                        failed += job.codes.get(job.pids[0], 0) != 0
+                    self.flushTask(out, err)
+        finally:
+            if oldHandler is not None:
+                signal.signal(signal.SIGINT, oldHandler)
+            if stdin is not None:
+                os.close(stdin)
+        return 130 if interrupted else min(failed, 101)
+
+    def readLines(self, fd):
+        buf = b""
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if line:
+                    yield line.decode()
+        if buf:
+            yield buf.decode()
+
+    def taskBuffer(self):
+        # An anonymous in-memory file when the kernel has them, so output of
+        # any size never blocks the task the way a pipe would.
+        if hasattr(os, "memfd_create"):
+            return os.memfd_create("parallel")
+        import tempfile
+        f = tempfile.TemporaryFile()
+        fd = os.dup(f.fileno())
+        f.close()
+        return fd
+
+    def flushTask(self, out, err):
+        try:
+            for fd, dest in ((out, self.stdout), (err, 2)):
+                os.lseek(fd, 0, os.SEEK_SET)
+                while chunk := os.read(fd, 65536):
+                    while chunk:
+                        chunk = chunk[os.write(dest, chunk):]
+        finally:
+            os.close(out)
+            os.close(err)
+
     def handle_bg(self):
         jt = self.ex.jobTable
         if not jt.list():
-            print("bg: no current job")
+            self.out("bg: no current job")
             return 1
-        idx = int(self.args[0][1:]) if self.args else len(jt.list())
+        idx = int(self.args[0][1:]) if self.args else jt.current().id
         job = jt.get_by_index(idx)
         if not job:
-            print(f"bg: {idx}: no such job")
+            self.out(f"bg: {idx}: no such job")
             return 1
 
+        job.background = True
         os.killpg(job.pgid, signal.SIGCONT)
         job.status = 'running'
-        print(f"[{job.pgid}] {job.cmd} &")
+        self.out(f"[{job.pgid}] {job.cmd} &")
         return 0
@@ -0,0 +1,44 @@
+import os, signal
+
+# Signals the shell ignores or handles itself; a launched command must start
+# with the default disposition for all of them.
+CHILD_SIGDEF = (
+    signal.SIGINT,
+    signal.SIGQUIT,
+    signal.SIGTSTP,
+    signal.SIGTTOU,
+    signal.SIGTTIN,
+    signal.SIGCHLD,
+    signal.SIGPIPE,
+)
+
+HAVE_SPAWN = hasattr(os, "posix_spawn")
+
+def redirectionActions(node):
+    actions = []
+    if node.stdin:
+        actions.append((os.POSIX_SPAWN_OPEN, 0, node.stdin, os.O_RDONLY, 0))
+    if node.stdout:
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if node.stdoutAppend else os.O_TRUNC)
+        actions.append((os.POSIX_SPAWN_OPEN, 1, node.stdout, flags, 0o644))
+    if node.stderr:
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if node.stderrAppend else os.O_TRUNC)
+        actions.append((os.POSIX_SPAWN_OPEN, 2, node.stderr, flags, 0o644))
+    return actions
+
+def spawn(exe, argv, env, node, pgid=0, stdin=None, stdout=None, stderr=None):
+    # pgid 0 starts a new process group, None keeps the shell's.
+    actions = []
+    if stdin is not None:
+        actions.append((os.POSIX_SPAWN_DUP2, stdin, 0))
+    if stdout is not None:
+        actions.append((os.POSIX_SPAWN_DUP2, stdout, 1))
+    if stderr is not None:
+        actions.append((os.POSIX_SPAWN_DUP2, stderr, 2))
+    actions.extend(redirectionActions(node))
+    group = {} if pgid is None else {"setpgroup": pgid}
+    return os.posix_spawn(exe, argv, env,
+                          file_actions=actions,
+                          setsigmask=(),
+                          setsigdef=CHILD_SIGDEF,
+                          **group)
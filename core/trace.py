@@ -0,0 +1,103 @@
+import os, sys, marshal, atexit
+
+# Debug dumps of the front end. Nothing here runs unless a dump was asked for:
+# call sites test `trace.active` (None by default) before doing any work.
+#
+#   --dump-tokens / --dump-ast        what to record
+#   --dump-file PATH                  sink, "-" (default) is stderr
+#   --dump-format jsonl|marshal       one JSON object per line, or a stream of
+#                                     marshal records (read back with load())
+#
+# The same settings can come from RAYSHELL_DUMP=tokens,ast, RAYSHELL_DUMP_FILE
+# and RAYSHELL_DUMP_FORMAT.
+
+FORMATS = ("jsonl", "marshal")
+BUFSIZE = 1 << 16
+
+active = None
+
+class Trace:
+    def __init__(self, sink="-", fmt="jsonl", tokens=False, ast=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown dump format {fmt!r}, expected one of {', '.join(FORMATS)}")
+        self.fmt = fmt
+        self.tokens = tokens
+        self.ast = ast
+        if sink == "-":
+            self.out = os.fdopen(os.dup(sys.stderr.fileno()), "wb", buffering=BUFSIZE)
+        else:
+            self.out = open(sink, "ab", buffering=BUFSIZE)
+
+    def write(self, record):
+        if self.fmt == "jsonl":
+            import json
+            self.out.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        else:
+            marshal.dump(record, self.out)
+
+    def dumpTokens(self, tokens):
+        if self.tokens:
+            self.write({"kind": "tokens",
+                        "tokens": [(t.type.value, t.value, t.line, t.col) for t in tokens]})
+
+    def tapTokens(self, tokens):
+        # For streamed input: pass tokens through, dumping them a line at a time.
+        if not self.tokens:
+            return tokens
+        return self._tap(tokens)
+
+    def _tap(self, tokens):
+        batch = []
+        for tok in tokens:
+            batch.append(tok)
+            if tok.type.value in ("NEWLINE", "EOF"):
+                self.dumpTokens(batch)
+                batch = []
+            yield tok
+
+    def dumpAST(self, node):
+        if self.ast and node is not None:
+            self.write({"kind": "ast", "ast": node.toDict()})
+
+    def close(self):
+        try:
+            self.out.close()
+        except OSError:
+            pass
+
+def configure(argv, environ=os.environ):
+    global active
+    wanted = {w for w in environ.get("RAYSHELL_DUMP", "").split(",") if w}
+    sink = environ.get("RAYSHELL_DUMP_FILE", "-")
+    fmt = environ.get("RAYSHELL_DUMP_FORMAT", "jsonl")
+
+    rest = []
+    it = iter(argv)
+    for arg in it:
+        if arg == "-c":
+            rest.append(arg)
+            rest.extend(it)
+            break
+        if arg == "--dump-tokens":
+            wanted.add("tokens")
+        elif arg == "--dump-ast":
+            wanted.add("ast")
+        elif arg == "--dump-file":
+            sink = next(it, "-")
+        elif arg == "--dump-format":
+            fmt = next(it, fmt)
+        else:
+            rest.append(arg)
+
+    if wanted:
+        active = Trace(sink, fmt, tokens="tokens" in wanted, ast="ast" in wanted)
+        atexit.register(active.close)
+    return rest
+
+def load(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
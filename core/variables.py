@@ -0,0 +1,83 @@
+import os
+
+class VariableStore:
+    # Shell variables live here rather than in os.environ, so setting one is a
+    # dict write instead of a putenv() call. The environment handed to a child
+    # is built from the exported names only when something is spawned, and is
+    # reused until an exported variable changes.
+    #
+    # Scopes pushed on top of the globals (prefix assignments such as
+    # `HOME=/tmp cd`) shadow them until popped. An exported scope, like the
+    # prefix assignments of a function call, is also in the environment of
+    # everything spawned while it is pushed.
+    #
+    # Arithmetic results are kept as ints, so a counter is never turned into
+    # a string and parsed back on every step. get() and environ() hand out
+    # strings; lookup() returns the value as stored.
+
+    def __init__(self, environ=None):
+        self.globals = dict(os.environ if environ is None else environ)
+        self.exported = set(self.globals)
+        self.scopes = []
+        # one flag per scope: is it exported
+        self.exports = []
+        self._environ = None
+
+    def get(self, name, default=""):
+        value = self.lookup(name, default)
+        return str(value) if type(value) is int else value
+
+    def lookup(self, name, default=None):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return self.globals.get(name, default)
+
+    def __contains__(self, name):
+        return any(name in scope for scope in self.scopes) or name in self.globals
+
+    def set(self, name, value, export=True):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                scope[name] = value
+                return
+        self.globals[name] = value
+        if export:
+            self.exported.add(name)
+        if name in self.exported:
+            self._environ = None
+
+    def declare(self, name, value):
+        # A variable of the innermost scope only, such as a function local.
+        self.scopes[-1][name] = value
+
+    def unset(self, name):
+        self.globals.pop(name, None)
+        if name in self.exported:
+            self.exported.discard(name)
+            self._environ = None
+
+    def push(self, scope=None, export=False):
+        self.scopes.append({} if scope is None else scope)
+        self.exports.append(export)
+
+    def pop(self):
+        self.exports.pop()
+        return self.scopes.pop()
+
+    def environ(self, overlay=None):
+        if self._environ is None:
+            g = self.globals
+            self._environ = {k: str(g[k]) if type(g[k]) is int else g[k] for k in self.exported if k in g}
+        layers = []
+        if True in self.exports:
+            layers = [scope for scope, export in zip(self.scopes, self.exports) if export]
+        if overlay:
+            layers.append(overlay)
+        if not layers:
+            return self._environ
+        env = dict(self._environ)
+        for layer in layers:
+            for k, v in layer.items():
+                env[k] = str(v) if type(v) is int else v
+        return env
@@ -0,0 +1,25 @@
+import unittest
+from core.lexer import Lexer
+from core.parser import Parser
+
+# In a condition `cmd > file` is a redirection, as it always was; < and >
+# compare only when the left side could never name a command.
+
+def condition(src):
+    return Parser(Lexer(line=f"if ({src}) -> {{ echo x }}").nextToken()).parse().condition
+
+class Comparisons(unittest.TestCase):
+    def testCommandRedirects(self):
+        for src, field in (("pwd > /tmp/out", "stdout"), ("sort < in.txt", "stdin")):
+            node = condition(src)
+            self.assertEqual(node.type.name, "COMMAND", src)
+            self.assertEqual(getattr(node, field), src.split()[-1])
+
+    def testValuesCompare(self):
+        for src in ("@x > 5", "3 < 10", '"a" < "b"', "@((1 + 2)) > 2", "pwd == x", "w >= 2"):
+            node = condition(src)
+            self.assertEqual(node.type.name, "BINARYOP", src)
+            self.assertEqual(node.op, src.split()[-2])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import io, unittest
+from core.lexer import Lexer
+from core.parser import Parser
+
+# Statements must carry the physical source line even where comments and
+# quoted newlines leave the lexer's own line count behind.
+
+SCRIPT = "# c1\n# c2\necho a\n\n# c3\ntrue\nx = \"multi\nline\"\nif (true) -> {\n  # inside\n  echo b\n}\n"
+
+def lines(statements):
+    out = []
+    for node in statements:
+        out.append((node.type.name, node.line))
+        if node.type.name == "IF":
+            out.extend((n.type.name, n.line) for n in node.consequent.statements)
+    return out
+
+EXPECTED = [("COMMAND", 3), ("COMMAND", 6), ("ASSIGNMENT", 7), ("IF", 9), ("COMMAND", 11)]
+
+class StatementLines(unittest.TestCase):
+    def testWholeInput(self):
+        self.assertEqual(lines(Parser(Lexer(line=SCRIPT).nextToken()).statements()), EXPECTED)
+
+    def testStreamed(self):
+        tokens = Lexer(reader=io.StringIO(SCRIPT)).iterTokens()
+        self.assertEqual(lines(Parser(tokens).statements()), EXPECTED)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import os, sys, subprocess, unittest
+
+# The shell's own command substitutions are not jobs: a bare `wait` or
+# `jobs` inside a for loop must not see the loop's producer.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def rayshell(script, timeout=30):
+    return subprocess.run([sys.executable, "-m", "core", "-c", script], cwd=ROOT,
+                          stdin=subprocess.DEVNULL, capture_output=True, text=True,
+                          start_new_session=True, timeout=timeout).stdout
+
+class CaptureJobs(unittest.TestCase):
+    def testWaitInLoopBody(self):
+        # seq fills the pipe long before the loop is done with it
+        out = rayshell("for i in @(seq 1 100000) -> { wait }\necho done @i")
+        self.assertEqual(out.splitlines()[-1], "done 100000")
+
+    def testJobsInLoopBody(self):
+        out = rayshell("for i in @(seq 1 3) -> { jobs }\necho done")
+        self.assertEqual(out.splitlines(), ["done"])
+
+if __name__ == "__main__":
+    unittest.main()